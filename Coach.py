@@ -1,18 +1,110 @@
 import logging
+import multiprocessing as mp
 import os
+import shutil
 import sys
+import threading
 from collections import deque
-from pickle import Pickler, Unpickler
-from random import shuffle
+from pickle import Unpickler
 
 import numpy as np
 from tqdm import tqdm
 
 from Arena import Arena
+from EvalCache import EvalCache
+from Game import Game
+from InferenceServer import InferenceServer
 from MCTS import MCTS
+from ParallelArena import ParallelArena
+from ReplayBuffer import ReplayBuffer
+from utils import setTorchThreads
 
 log = logging.getLogger(__name__)
 
+selfPlayCoach = None  # the Coach of a self-play process, set by initSelfPlayWorker
+
+
+def initSelfPlayWorker(game, nnetClass, args, checkpoint, numThreads, clients=None, clientIds=None):
+    """
+    Builds the Coach of a self-play process with a network that loads the
+    weights of the current iteration from checkpoint, a (folder, filename)
+    tuple, once. If clients are given the process takes the InferenceClient
+    with the next id from the clientIds queue instead of a network.
+    """
+    global selfPlayCoach
+    setTorchThreads(numThreads)
+    if clients is not None:
+        nnet = clients[clientIds.get()]
+    else:
+        nnet = nnetClass(game)
+        nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+    selfPlayCoach = Coach(game, nnet, args, selfPlayOnly=True)
+
+
+def playEpisode(seed):
+    """
+    Plays one episode of self-play in a self-play process.
+
+    Returns:
+        trainExamples: see Coach.executeEpisode
+    """
+    np.random.seed(seed)
+    coach = selfPlayCoach
+    coach.mcts = MCTS(coach.game, coach.nnet, coach.args, coach.evalCache, coach.nnetVersion)  # reset search tree
+    return coach.executeEpisode()
+
+
+def playLockstepEpisodes(task):
+    """
+    Plays the numGames episodes of task, a (seed, numGames) tuple, in
+    lockstep in a self-play process.
+
+    Returns:
+        episodes: the trainExamples of every episode, see
+                  Coach.executeEpisodesLockstep
+    """
+    seed, numGames = task
+    np.random.seed(seed)
+    return selfPlayCoach.executeEpisodesLockstep(numGames)
+
+
+def playTaggedEpisode(seed, version, checkpoint):
+    """
+    Plays one episode of self-play in a self-play process with the model of
+    the given version, which is loaded from checkpoint, a (folder, filename)
+    tuple, if the process does not hold it yet.
+
+    Returns:
+        version: the model version that played the episode
+        trainExamples: see Coach.executeEpisode
+    """
+    coach = selfPlayCoach
+    if version != coach.nnetVersion:
+        coach.nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+        coach.nnetVersion = version
+    return version, playEpisode(seed)
+
+
+def pitCheckpoints(game, nnetClass, args, previous, candidate, numThreads):
+    """
+    Pits the network of the checkpoint candidate against the one of previous,
+    both (folder, filename) tuples, in an evaluator process.
+
+    Returns:
+        pwins, nwins, draws: the games won by previous, by candidate and the
+                             draws, see Arena.playGames
+    """
+    setTorchThreads(numThreads)
+    pnet = nnetClass(game)
+    pnet.load_checkpoint(folder=previous[0], filename=previous[1])
+    nnet = nnetClass(game)
+    nnet.load_checkpoint(folder=candidate[0], filename=candidate[1])
+    pmcts = MCTS(game, pnet, args)
+    nmcts = MCTS(game, nnet, args)
+    arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
+                  lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), game, game.display)
+    return arena.playGames(args.arenaCompare)
+
 
 class Coach():
     """
@@ -20,13 +112,24 @@ class Coach():
     in Game and NeuralNet. args are specified in main.py.
     """
 
-    def __init__(self, game, nnet, args):
+    MAX_EXAMPLES_PER_GAME = 150
+
+    def __init__(self, game, nnet, args, selfPlayOnly=False):
         self.game = game
         self.nnet = nnet
-        self.pnet = self.nnet.__class__(self.game)  # the competitor network
+        # the competitor network, self-play processes never pit networks
+        self.pnet = None if selfPlayOnly else self.nnet.__class__(self.game)
         self.args = args
-        self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.trainExamplesHistory = []  # history of examples from args.numItersForTrainExamplesHistory latest iterations
+        # network evaluations shared by all searches, keyed by the model version
+        cacheSize = getattr(self.args, 'evalCacheSize', 0)
+        self.evalCache = EvalCache(cacheSize) if cacheSize > 0 else None
+        self.nnetVersion = 0  # changes whenever the weights of nnet change
+        self.lastVersion = 0  # the highest version handed out so far, versions are never reused
+        self.mcts = MCTS(self.game, self.nnet, self.args, self.evalCache, self.nnetVersion)
+        # examples of the args.numItersForTrainExamplesHistory latest iterations, one shard per iteration
+        self.replayBuffer = ReplayBuffer(os.path.join(getattr(self.args, 'checkpoint', './temp/'), 'replay'),
+                                         getattr(self.args, 'numItersForTrainExamplesHistory', 20),
+                                         self.game.getActionSize(), sparse=self.nnet.sparsePolicy)
         self.skipFirstSelfPlay = False  # can be overriden in loadTrainExamples()
 
     def executeEpisode(self):
@@ -40,16 +143,21 @@ class Coach():
         It uses a temp=1 if episodeStep < tempThreshold, and thereafter
         uses temp=0.
 
+        With playout cap randomization only a fraction args.playoutCapProb of
+        the moves get the full numMCTSSims search and become training
+        examples. The other moves are played after a fast search of
+        args.numMCTSSimsFast simulations and are not recorded.
+
         Returns:
-            trainExamples: a list of examples of the form (canonicalBoard, currPlayer, pi,v)
-                           pi is the MCTS informed policy vector, v is +1 if
-                           the player eventually won the game, else -1.
+            trainExamples: a list of examples of the form (canonicalBoard, pi, v)
+                           pi is the MCTS informed policy as a sparse
+                           (actions, probs) pair, v is +1 if the player
+                           eventually won the game, else -1.
         """
         trainExamples = []
         board = self.game.getInitBoard()
         self.curPlayer = 1
         episodeStep = 0
-        MAX_EXAMPLES_PER_GAME = 150
         print(f"Initial board: {self.game.display(board)}\n", flush=True)
         while True:
             episodeStep += 1
@@ -58,21 +166,122 @@ class Coach():
             temp = int(episodeStep < self.args.tempThreshold)
 
 
-            pi = self.mcts.getActionProb(canonicalBoard, temp=temp)
-            
-            sym = self.game.getSymmetries(canonicalBoard, pi)
-            for b, p in sym:
-                trainExamples.append([b, self.curPlayer, p, None])
+            fullSearch = np.random.random() < getattr(self.args, 'playoutCapProb', 1.)
+            numMCTSSims = None if fullSearch else self.args.numMCTSSimsFast
+            if getattr(self.args, 'gumbel', False):
+                # the improved policy is the training target and the Gumbel
+                # noise already explores, so play the action the search picked
+                pi = self.mcts.getActionProb(canonicalBoard, temp=1, numMCTSSims=numMCTSSims, sparse=True)
+            else:
+                # the visit counts are the training target, so never cut a full search short
+                pi = self.mcts.getActionProb(canonicalBoard, temp=temp, earlyStop=False if fullSearch else None,
+                                             numMCTSSims=numMCTSSims, sparse=True)
+
+            if fullSearch:
+                sym = self.getSymmetries(canonicalBoard, pi)
+                for b, p in sym:
+                    trainExamples.append([b, self.curPlayer, p, None])
 
-            action = np.random.choice(len(pi), p=pi)
+            if getattr(self.args, 'gumbel', False):
+                action = self.mcts.selectedAction
+            else:
+                action = np.random.choice(pi[0], p=pi[1])
+            self.mcts.advance(action)
             board, self.curPlayer = self.game.getNextState(board, self.curPlayer, action)
             #print(f"Episode step {episodeStep} for player {self.curPlayer} with action {action}, board:\n{self.game.display(board)}")
             r = self.game.getGameEnded(board, self.curPlayer)
-            if len(trainExamples) > MAX_EXAMPLES_PER_GAME:
-                trainExamples = trainExamples[-MAX_EXAMPLES_PER_GAME:]
+            if len(trainExamples) > self.MAX_EXAMPLES_PER_GAME:
+                trainExamples = trainExamples[-self.MAX_EXAMPLES_PER_GAME:]
             if r != 0:
                 return [(x[0], x[2], r * ((-1) ** (x[1] != self.curPlayer))) for x in trainExamples]
 
+    def executeEpisodesLockstep(self, numGames):
+        """
+        Plays numGames episodes of self-play in lockstep in this process. Every
+        game has its own MCTS tree. In every round each game contributes the
+        next leaf its search needs (see MCTS.searchLeaves) and all of these
+        leaves are evaluated with one nnet.predictBatch call, so the network
+        sees batches of up to numGames boards without any other process.
+        Temperature, playout cap randomization and the examples are the same
+        as in executeEpisode; Gumbel searches are not supported.
+
+        Returns:
+            episodes: the trainExamples of every game, see executeEpisode
+        """
+        episodes = [None] * numGames
+        games = [{'id': g, 'board': self.game.getInitBoard(), 'player': 1, 'step': 0, 'examples': [],
+                  'mcts': MCTS(self.game, self.nnet, self.args, self.evalCache, self.nnetVersion)}
+                 for g in range(numGames)]
+        for game in games:
+            self.startMove(game)
+
+        while games:
+            waiting = []
+            boards = []
+            for game in games:
+                board = self.nextLeaf(game, episodes)
+                if board is not None:
+                    waiting.append(game)
+                    boards.append(board)
+            if boards:
+                pis, vs = self.nnet.predictBatch(boards)
+                for game, pi, v in zip(waiting, pis, vs):
+                    game['evaluation'] = (pi, v)
+            games = waiting
+        return episodes
+
+    def startMove(self, game):
+        """
+        Starts the search for the next move of a lockstep game.
+        """
+        game['step'] += 1
+        game['canonicalBoard'] = self.game.getCanonicalForm(game['board'], game['player'])
+        game['temp'] = int(game['step'] < self.args.tempThreshold)
+        game['fullSearch'] = np.random.random() < getattr(self.args, 'playoutCapProb', 1.)
+        numMCTSSims = None if game['fullSearch'] else self.args.numMCTSSimsFast
+        game['search'] = game['mcts'].searchLeaves(game['canonicalBoard'], numMCTSSims)
+        game['evaluation'] = None
+
+    def nextLeaf(self, game, episodes):
+        """
+        Hands the last evaluation to the search of a lockstep game and plays
+        its moves whenever a search is done.
+
+        Returns:
+            board: the next leaf of the game that needs an evaluation, or None
+                   if the game has ended and its examples are in episodes
+        """
+        while True:
+            try:
+                return game['search'].send(game['evaluation'])
+            except StopIteration:
+                pass
+
+            mcts = game['mcts']
+            pi = mcts.rootPolicy(game['temp'], sparse=True)
+            if game['fullSearch']:
+                for b, p in self.getSymmetries(game['canonicalBoard'], pi):
+                    game['examples'].append([b, game['player'], p, None])
+            action = np.random.choice(pi[0], p=pi[1])
+            mcts.advance(action)
+            game['board'], game['player'] = self.game.getNextState(game['board'], game['player'], action)
+            r = self.game.getGameEnded(game['board'], game['player'])
+            game['examples'] = game['examples'][-self.MAX_EXAMPLES_PER_GAME:]
+            if r != 0:
+                episodes[game['id']] = [(x[0], x[2], r * ((-1) ** (x[1] != game['player']))) for x in game['examples']]
+                return None
+            self.startMove(game)
+
+    def getSymmetries(self, board, pi):
+        """
+        Returns:
+            symmForms: the (board, pi) symmetries of game.getSparseSymmetries
+                       for the sparse (actions, probs) policy pi
+        """
+        if hasattr(self.game, 'getSparseSymmetries'):
+            return self.game.getSparseSymmetries(board, pi)
+        return Game.getSparseSymmetries(self.game, board, pi)
+
     def learn(self):
         """
         Performs numIters iterations with numEps episodes of self-play in each
@@ -80,7 +289,11 @@ class Coach():
         examples in trainExamples (which has a maximum length of maxlenofQueue).
         It then pits the new neural network against the old one and accepts it
         only if it wins >= updateThreshold fraction of games.
+
+        With args.pipeline the phases overlap instead, see learnPipelined.
         """
+        if getattr(self.args, 'pipeline', False):
+            return self.learnPipelined()
 
         for i in range(1, self.args.numIters + 1):
             # bookkeeping
@@ -89,33 +302,36 @@ class Coach():
             if not self.skipFirstSelfPlay or i > 1:
                 iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
 
-                for _ in tqdm(range(self.args.numEps), desc="Self Play"):
-                    self.mcts = MCTS(self.game, self.nnet, self.args)  # reset search tree
-                    iterationTrainExamples += self.executeEpisode()
-
-                # save the iteration examples to the history 
-                self.trainExamplesHistory.append(iterationTrainExamples)
+                numGames = getattr(self.args, 'lockstepGames', 1)
+                if getattr(self.args, 'gumbel', False) and numGames > 1:
+                    log.warning('Gumbel searches cannot run in lockstep, playing the episodes one by one.')
+                    numGames = 1
+                if getattr(self.args, 'numSelfPlayWorkers', 1) > 1:
+                    for episode in self.selfPlayParallel(numGames):
+                        iterationTrainExamples += episode
+                elif numGames > 1:
+                    for start in tqdm(range(0, self.args.numEps, numGames), desc="Self Play"):
+                        for episode in self.executeEpisodesLockstep(min(numGames, self.args.numEps - start)):
+                            iterationTrainExamples += episode
+                else:
+                    for _ in tqdm(range(self.args.numEps), desc="Self Play"):
+                        self.mcts = MCTS(self.game, self.nnet, self.args, self.evalCache, self.nnetVersion)  # reset search tree
+                        iterationTrainExamples += self.executeEpisode()
+                if self.evalCache is not None:
+                    log.info(f'Evaluation cache: {self.evalCache}')
 
-            if len(self.trainExamplesHistory) > self.args.numItersForTrainExamplesHistory:
-                log.warning(
-                    f"Removing the oldest entry in trainExamples. len(trainExamplesHistory) = {len(self.trainExamplesHistory)}")
-                self.trainExamplesHistory.pop(0)
-            # backup history to a file
-            # NB! the examples were collected using the model from the previous iteration, so (i-1)  
-            self.saveTrainExamples(i - 1)
-
-            # shuffle examples before training
-            trainExamples = []
-            for e in self.trainExamplesHistory:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+                # write the iteration examples as a new shard, the oldest one leaves the window
+                self.replayBuffer.addShard(iterationTrainExamples)
 
             # training new network, keeping a copy of the old one
             self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
             self.pnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
-            pmcts = MCTS(self.game, self.pnet, self.args)
+            pnetVersion = self.nnetVersion
 
-            self.nnet.train(trainExamples)
+            # the network samples its batches from the window of the replay buffer
+            self.nnet.train(self.replayBuffer)
+            self.lastVersion += 1
+            self.nnetVersion = self.lastVersion
             #Nur fürs aller erste training, damit wir mal eine haben
             #if(i <= 1):
              #   log.info(f"Auto-accepting model in early iteration {i}")
@@ -123,48 +339,255 @@ class Coach():
                # self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
                 #continue
 
-            pmcts = MCTS(self.game, self.pnet, self.args)
-            nmcts = MCTS(self.game, self.nnet, self.args)
-
             log.info('PITTING AGAINST PREVIOUS VERSION')
-            arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
-                          lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game, self.game.display)
-            pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+            if getattr(self.args, 'numArenaWorkers', 1) > 1:
+                # the arena processes load both networks from checkpoints
+                self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='arena.pth.tar')
+                arena = ParallelArena(self.game, self.nnet.__class__, self.args,
+                                      (self.args.checkpoint, 'temp.pth.tar'), (self.args.checkpoint, 'arena.pth.tar'),
+                                      numWorkers=self.args.numArenaWorkers, seed=np.random.randint(2 ** 31))
+                pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+            else:
+                pmcts = MCTS(self.game, self.pnet, self.args, self.evalCache, pnetVersion)
+                nmcts = MCTS(self.game, self.nnet, self.args, self.evalCache, self.nnetVersion)
+                arena = Arena(lambda x: np.argmax(pmcts.getActionProb(x, temp=0)),
+                              lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game, self.game.display)
+                pwins, nwins, draws = arena.playGames(self.args.arenaCompare)
+                if getattr(self.args, 'mctsEarlyStop', False):
+                    log.info(f'Early stopping skipped {pmcts.totalSimsSaved + nmcts.totalSimsSaved} arena simulations')
 
             log.info('NEW/PREV WINS : %d / %d ; DRAWS : %d' % (nwins, pwins, draws))
             if pwins + nwins == 0 or float(nwins) / (pwins + nwins) < self.args.updateThreshold:
                 log.info('REJECTING NEW MODEL')
                 self.nnet.load_checkpoint(folder=self.args.checkpoint, filename='temp.pth.tar')
+                self.nnetVersion = pnetVersion
             else:
                 log.info('ACCEPTING NEW MODEL')
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename=self.getCheckpointFile(i))
                 self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='best.pth.tar')
 
-    def getCheckpointFile(self, iteration):
-        return 'checkpoint_' + str(iteration) + '.pth.tar'
+    def selfPlayParallel(self, numGames=1):
+        """
+        Plays numEps episodes of self-play in args.numSelfPlayWorkers
+        processes. The processes load the current weights of nnet once, from
+        a checkpoint written for them, and share the cores evenly between
+        their torch threads. Each episode gets its own seed. With numGames > 1
+        every task of a process is a group of up to numGames episodes that it
+        plays in lockstep, see executeEpisodesLockstep, with one seed per
+        group.
+
+        With args.inferenceServer the processes hold no network. A single
+        InferenceServer loads the weights instead and evaluates the boards of
+        all processes in batches of up to args.inferenceBatchSize boards,
+        waiting at most args.inferenceMaxWait seconds to fill one.
+
+        Returns:
+            episodes: the trainExamples of every episode, in the order the
+                      episodes were started
+        """
+        numWorkers = self.args.numSelfPlayWorkers
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='selfplay.pth.tar')
+        checkpoint = (self.args.checkpoint, 'selfplay.pth.tar')
+        numThreads = mp.cpu_count() // numWorkers
+        seeds = np.random.randint(2 ** 31, size=self.args.numEps)
+        groups = [min(numGames, self.args.numEps - start) for start in range(0, self.args.numEps, numGames)]
+        ctx = mp.get_context('spawn')
+
+        server = None
+        clients = None
+        clientIds = None
+        if getattr(self.args, 'inferenceServer', False):
+            server = InferenceServer(self.game, self.nnet.__class__, checkpoint, numWorkers,
+                                     maxBatchSize=getattr(self.args, 'inferenceBatchSize', None),
+                                     maxWait=getattr(self.args, 'inferenceMaxWait', 0.005),
+                                     slotSize=max(getattr(self.args, 'mctsBatchSize', 1), numGames))
+            clients = server.clients
+            clientIds = ctx.Queue()
+            for c in range(numWorkers):
+                clientIds.put(c)
+            numThreads = 1
+
+        try:
+            with ctx.Pool(numWorkers, initializer=initSelfPlayWorker,
+                          initargs=(self.game, self.nnet.__class__, self.args, checkpoint, numThreads, clients,
+                                    clientIds)) as pool:
+                if numGames > 1:
+                    tasks = pool.imap(playLockstepEpisodes, zip(seeds, groups))
+                    return [episode for episodes in tqdm(tasks, total=len(groups), desc="Self Play")
+                            for episode in episodes]
+                return list(tqdm(pool.imap(playEpisode, seeds), total=self.args.numEps, desc="Self Play"))
+        finally:
+            if server is not None:
+                server.close()
+
+    def learnPipelined(self):
+        """
+        Runs self-play, training and gating at the same time instead of one
+        after the other. args.numSelfPlayWorkers processes keep playing
+        episodes with the latest accepted model. Whenever numEps new episodes
+        are in, the examples become a new shard of the replay buffer and nnet
+        is trained on its window in this process, while the self-play goes
+        on. The trained candidate is pitted against the
+        accepted model by an evaluator process; if it wins >= updateThreshold
+        of the games it becomes the model of all following episodes. Training
+        continues from the latest candidate either way, and a candidate that
+        finishes while the evaluator is busy is skipped in favour of the next.
+
+        Every example is tagged with the version of the model that played it,
+        as (board, pi, v, version), see ReplayBuffer.version.
+        Models are saved as model_<version>.pth.tar in args.checkpoint while
+        they are in use. In the end only the accepted model is kept and
+        loaded into nnet.
+
+        The self-play processes always use their own network and play one
+        episode at a time, and the evaluator plays its games serially, so
+        args.inferenceServer, args.lockstepGames and args.numArenaWorkers do
+        not apply.
+        """
+        for name, unused in (('inferenceServer', False), ('lockstepGames', 1), ('numArenaWorkers', 1)):
+            if getattr(self.args, name, unused) != unused:
+                log.warning(f'args.{name} does not apply to the pipelined mode and is ignored.')
+        ctx = mp.get_context('spawn')
+        numWorkers = getattr(self.args, 'numSelfPlayWorkers', 1)
+        numThreads = max(1, mp.cpu_count() // (numWorkers + 2))
+        folder = self.args.checkpoint
+        self.acceptedVersion = self.nnetVersion
+        self.nnet.save_checkpoint(folder=folder, filename=self.getVersionFile(self.acceptedVersion))
 
-    def saveTrainExamples(self, iteration):
+        finished = []  # (version, trainExamples) of the episodes played since the last training
+        errors = []
+        episodesChanged = threading.Condition()
+        running = [True]
+
+        def submit():
+            version = self.acceptedVersion
+            pool.apply_async(playTaggedEpisode, (np.random.randint(2 ** 31), version,
+                                                 (folder, self.getVersionFile(version))),
+                             callback=episodeDone, error_callback=episodeFailed)
+
+        def episodeDone(result):
+            with episodesChanged:
+                finished.append(result)
+                episodesChanged.notify()
+            if running[0]:
+                submit()
+
+        def episodeFailed(error):
+            with episodesChanged:
+                errors.append(error)
+                episodesChanged.notify()
+
+        pool = ctx.Pool(numWorkers, initializer=initSelfPlayWorker,
+                        initargs=(self.game, self.nnet.__class__, self.args,
+                                  (folder, self.getVersionFile(self.acceptedVersion)), numThreads))
+        evaluator = ctx.Pool(1)
+        evaluation = None  # (candidate version, pending result) of the running evaluation
+        try:
+            for _ in range(2 * numWorkers):
+                submit()
+
+            for i in range(1, self.args.numIters + 1):
+                log.info(f'Starting Iter #{i} ...')
+                with episodesChanged:
+                    while len(finished) < self.args.numEps and not errors:
+                        episodesChanged.wait()
+                    if errors:
+                        raise errors[0]
+                    episodes = finished[:]
+                    finished.clear()
+
+                iterationTrainExamples = deque([], maxlen=self.args.maxlenOfQueue)
+                for version, examples in episodes:
+                    iterationTrainExamples += [(*example, version) for example in examples]
+                self.replayBuffer.addShard(iterationTrainExamples)
+                self.nnet.train(self.replayBuffer)
+                self.lastVersion += 1
+                self.nnetVersion = self.lastVersion
+                self.nnet.save_checkpoint(folder=folder, filename=self.getVersionFile(self.nnetVersion))
+
+                if evaluation is not None and evaluation[1].ready():
+                    self.gate(*evaluation, i)
+                    self.removeVersionFile(evaluation[0])
+                    evaluation = None
+                if evaluation is None:
+                    log.info(f'Pitting model {self.nnetVersion} against model {self.acceptedVersion}')
+                    evaluation = (self.nnetVersion, evaluator.apply_async(
+                        pitCheckpoints, (self.game, self.nnet.__class__, self.args,
+                                         (folder, self.getVersionFile(self.acceptedVersion)),
+                                         (folder, self.getVersionFile(self.nnetVersion)), numThreads)))
+                else:
+                    log.info(f'Evaluator busy, skipping the gating of model {self.nnetVersion}')
+                    self.removeVersionFile(self.nnetVersion)
+
+            if evaluation is not None:
+                self.gate(*evaluation, self.args.numIters)
+        finally:
+            running[0] = False
+            pool.terminate()
+            evaluator.terminate()
+
+        # continue from the accepted model, not from the last candidate
+        self.nnet.load_checkpoint(folder=folder, filename=self.getVersionFile(self.acceptedVersion))
+        self.nnetVersion = self.acceptedVersion
+        for version in range(self.lastVersion + 1):
+            self.removeVersionFile(version)
+
+    def gate(self, candidate, result, iteration):
+        """
+        Accepts the model version candidate for self-play if it won at least
+        updateThreshold of the decided games of its evaluation result.
+        """
+        pwins, nwins, draws = result.get()
+        log.info(f'NEW/PREV WINS (model {candidate} vs {self.acceptedVersion}) : %d / %d ; DRAWS : %d'
+                 % (nwins, pwins, draws))
+        if pwins + nwins == 0 or float(nwins) / (pwins + nwins) < self.args.updateThreshold:
+            log.info('REJECTING NEW MODEL')
+            return
+        log.info('ACCEPTING NEW MODEL')
+        self.acceptedVersion = candidate
         folder = self.args.checkpoint
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        filename = os.path.join(folder, self.getCheckpointFile(iteration) + ".examples")
-        with open(filename, "wb+") as f:
-            Pickler(f).dump(self.trainExamplesHistory)
-        f.closed
+        source = os.path.join(folder, self.getVersionFile(candidate))
+        shutil.copyfile(source, os.path.join(folder, self.getCheckpointFile(iteration)))
+        shutil.copyfile(source, os.path.join(folder, 'best.pth.tar'))
+
+    def getVersionFile(self, version):
+        return 'model_' + str(version) + '.pth.tar'
+
+    def removeVersionFile(self, version):
+        """
+        Deletes the model file of version unless it is the accepted model,
+        which the self-play processes may still load.
+        """
+        path = os.path.join(self.args.checkpoint, self.getVersionFile(version))
+        if version != self.acceptedVersion and os.path.isfile(path):
+            os.remove(path)
+
+    def getCheckpointFile(self, iteration):
+        return 'checkpoint_' + str(iteration) + '.pth.tar'
 
     def loadTrainExamples(self):
+        """
+        Opens the replay shards in the replay folder next to the model of
+        args.load_folder_file. If there are none but the model has examples
+        pickled by older versions of this class, they are converted to shards
+        in that folder first, so they are only converted once.
+        """
+        folder = os.path.join(self.args.load_folder_file[0], 'replay')
         modelFile = os.path.join(self.args.load_folder_file[0], self.args.load_folder_file[1])
         examplesFile = modelFile + ".examples"
-        if not os.path.isfile(examplesFile):
-            log.warning(f'File "{examplesFile}" with trainExamples not found!')
+        if not ReplayBuffer.listShards(folder) and os.path.isfile(examplesFile):
+            log.info("File with pickled trainExamples found. Converting it to replay shards...")
+            converted = ReplayBuffer(folder, self.replayBuffer.window, self.game.getActionSize())
+            with open(examplesFile, "rb") as f:
+                for examples in Unpickler(f).load():
+                    converted.addShard(examples)
+        if not self.replayBuffer.open(folder):
+            log.warning(f'No replay shards found in "{folder}"!')
             r = input("Continue? [y|n]")
             if r != "y":
                 sys.exit()
-        else:
-            log.info("File with trainExamples found. Loading it...")
-            with open(examplesFile, "rb") as f:
-                self.trainExamplesHistory = Unpickler(f).load()
-            log.info('Loading done!')
+            return
+        log.info('Loading done!')
 
-            # examples based on the model were already collected (loaded)
-            self.skipFirstSelfPlay = True
+        # examples based on the model were already collected (loaded)
+        self.skipFirstSelfPlay = True
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+
+
+class EvalCache():
+    """
+    A bounded cache of neural network evaluations that sits between MCTS and
+    nnet.predict. An entry holds the valid actions of a board, their
+    renormalized priors and the value of the board, i.e. exactly what
+    MCTS.expand stores for a leaf, so a hit skips the network as well as the
+    valid move generation.
+
+    Entries are keyed by (model version, board key), where the board key is
+    MCTS.getKey of the canonical board. Evaluations of different networks
+    never mix as long as every network that shares the cache gets its own
+    version. The least recently used entries are dropped once more than
+    maxSize are stored.
+
+    Every process holds its own cache, and its entries do not count towards
+    the mctsMaxNodes/mctsMaxBytes budget of the trees, so maxSize bounds the
+    extra memory of each process.
+    """
+
+    def __init__(self, maxSize=100000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns:
+            entry: the cached (actions, priors, v) for key, or None
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, entry):
+        """
+        Stores the evaluation entry, an (actions, priors, v) tuple, for key.
+        """
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def hitRate(self):
+        """
+        Returns:
+            rate: the fraction of lookups that were hits, 0 before the first
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def clear(self):
+        """
+        Drops all local entries and resets the hit and miss counts.
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'{len(self.entries)} entries, {self.hits} hits, {self.misses} misses ({self.hitRate():.1%})'
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Game():
     """
     This class specifies the base Game class. To define your own game, subclass
@@ -59,6 +62,21 @@ class Game():
         """
         pass
 
+    def getValidActions(self, board, player):
+        """
+        Input:
+            board: current board
+            player: current player
+
+        Returns:
+            validActions: a sorted numpy array with the indices of the moves
+                          that are valid from the current board and player.
+                          Used by MCTS instead of getValidMoves, games with a
+                          large action space should override it so the binary
+                          vector is never built.
+        """
+        return np.flatnonzero(self.getValidMoves(board, player))
+
     def getGameEnded(self, board, player):
         """
         Input:
@@ -101,6 +119,29 @@ class Game():
         """
         pass
 
+    def getSparseSymmetries(self, board, pi):
+        """
+        Input:
+            board: current board
+            pi: sparse policy, an (actions, probs) pair of the actions with a
+                nonzero probability and their probabilities
+
+        Returns:
+            symmForms: a list of [(board,pi)] like getSymmetries, with sparse
+                       policies. Defaults to expanding pi for getSymmetries;
+                       games with a large action space should override it,
+                       games without symmetries simply return [(board, pi)].
+        """
+        actions, probs = pi
+        dense = np.zeros(self.getActionSize())
+        dense[actions] = probs
+        symmForms = []
+        for b, p in self.getSymmetries(board, dense):
+            p = np.asarray(p)
+            nonzero = np.flatnonzero(p)
+            symmForms.append((b, (nonzero.astype(np.int32), p[nonzero])))
+        return symmForms
+
     def stringRepresentation(self, board):
         """
         Input:
@@ -111,3 +152,16 @@ class Game():
                          Required by MCTS for hashing.
         """
         pass
+
+    def hashKey(self, board):
+        """
+        Input:
+            board: current board
+
+        Returns:
+            key: a hashable key of the board, used by MCTS to identify its
+                 nodes. Defaults to stringRepresentation; games whose boards
+                 are large should return a 64 bit integer such as a Zobrist
+                 hash to keep the keys held by the tree small.
+        """
+        return self.stringRepresentation(board)
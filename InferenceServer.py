@@ -0,0 +1,230 @@
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from NeuralNet import NeuralNet
+from utils import setTorchThreads
+
+log = logging.getLogger(__name__)
+
+
+def serve(game, nnetClass, checkpoint, layout, requests, done, failed, maxBatchSize, maxWait, numThreads):
+    """
+    The server process. It builds the network and answers requests until a
+    None request stops it, see serveRequests. If anything fails, e.g.
+    loading the checkpoint or nnet.predictBatch, it sets failed and wakes up
+    all clients, which then raise instead of waiting forever.
+    """
+    blocks = []
+    try:
+        setTorchThreads(numThreads)
+        nnet = nnetClass(game)
+        if checkpoint is not None:
+            nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+        blocks, slots = attach(layout)
+        serveRequests(nnet, slots, requests, done, maxBatchSize, maxWait)
+        del slots
+    except Exception:
+        log.exception('The inference server failed.')
+        failed.set()
+        for event in done:
+            event.set()
+    finally:
+        for shm in blocks:
+            shm.close()
+
+
+def serveRequests(nnet, slots, requests, done, maxBatchSize, maxWait):
+    """
+    The loop of the server process. It waits for a request, keeps collecting
+    requests until maxBatchSize boards are waiting or maxWait seconds have
+    passed, evaluates all of their boards with one nnet.predictBatch call
+    and wakes up the clients. A None request stops the server.
+    """
+    stop = False
+    while not stop:
+        request = requests.get()
+        if request is None:
+            break
+        batch = [request]
+        numBoards = request[1]
+        deadline = time.perf_counter() + maxWait
+        while numBoards < maxBatchSize:
+            try:
+                request = requests.get(timeout=max(0., deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request is None:
+                stop = True
+                break
+            batch.append(request)
+            numBoards += request[1]
+
+        boards = np.concatenate([slots['boards'][c, :n] for c, n in batch])
+        pis, vs = nnet.predictBatch(boards)
+        start = 0
+        for c, n in batch:
+            slots['pis'][c, :n] = pis[start:start + n]
+            slots['vs'][c, :n] = vs[start:start + n]
+            start += n
+            done[c].set()
+
+
+def attach(layout):
+    """
+    Opens the shared memory blocks of layout, which maps a name to the
+    (block name, shape, dtype) of an array.
+
+    Returns:
+        blocks: the opened SharedMemory blocks
+        slots: the arrays backed by them, by name
+    """
+    blocks = []
+    slots = {}
+    for name, (blockName, shape, dtype) in layout.items():
+        shm = shared_memory.SharedMemory(name=blockName)
+        blocks.append(shm)
+        slots[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return blocks, slots
+
+
+class InferenceClient(NeuralNet):
+    """
+    Stands in for the network in a worker process and sends its boards to an
+    InferenceServer. The boards go through the shared memory slot of the
+    client, only the client id and the number of boards through the request
+    queue. A client must be handed to its process when that process is
+    started, e.g. as an initializer argument of a pool.
+
+    The threads of a threaded search share the one slot of their client, so
+    their requests are sent one after the other. If the server has failed,
+    predictBatch raises a RuntimeError.
+    """
+
+    def __init__(self, clientId, layout, requests, done, failed, slotSize):
+        self.clientId = clientId
+        self.layout = layout
+        self.requests = requests
+        self.done = done
+        self.failed = failed
+        self.slotSize = slotSize
+        self.blocks = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['blocks'] = None
+        state['slots'] = None
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def predict(self, board):
+        pis, vs = self.predictBatch([board])
+        return pis[0], vs[0]
+
+    def predictBatch(self, boards):
+        """
+        Evaluates boards on the server, at most slotSize of them per request.
+
+        Returns:
+            pis: the policies of the boards as a (len(boards), actionSize) array
+            vs: their values
+        """
+        with self.lock:
+            return self.evaluate(boards)
+
+    def evaluate(self, boards):
+        if self.failed.is_set():
+            raise RuntimeError('The inference server failed, see its log for the error.')
+        if self.slots is None:
+            self.blocks, self.slots = attach(self.layout)
+        c = self.clientId
+        pis = []
+        vs = []
+        for start in range(0, len(boards), self.slotSize):
+            chunk = boards[start:start + self.slotSize]
+            n = len(chunk)
+            self.slots['boards'][c, :n] = np.asarray(chunk)
+            self.requests.put((c, n))
+            self.done[c].wait()
+            self.done[c].clear()
+            if self.failed.is_set():
+                raise RuntimeError('The inference server failed, see its log for the error.')
+            pis.append(self.slots['pis'][c, :n].copy())
+            vs.append(self.slots['vs'][c, :n].copy())
+        return np.concatenate(pis), np.concatenate(vs)
+
+
+class InferenceServer():
+    """
+    A process that owns the network and evaluates the boards of numClients
+    worker processes in dynamic batches. Every client has a slot of
+    slotSize boards in shared memory, see InferenceClient, which implements
+    predict and predictBatch so that MCTS can use it in place of the
+    network. The server batches whatever requests arrive within maxWait
+    seconds of the first one, up to maxBatchSize boards (by default one full
+    slot per client).
+
+    The network is built as nnetClass(game) in the server process and loads
+    its weights from checkpoint, a (folder, filename) tuple, if given. If the
+    server fails the clients raise instead of waiting for it.
+    """
+
+    def __init__(self, game, nnetClass, checkpoint, numClients, maxBatchSize=None, maxWait=0.005, slotSize=1,
+                 numThreads=None):
+        ctx = mp.get_context('spawn')
+        board = np.asarray(game.getInitBoard())
+        arrays = {
+            'boards': ((numClients, slotSize) + board.shape, board.dtype),
+            'pis': ((numClients, slotSize, game.getActionSize()), np.dtype(np.float32)),
+            'vs': ((numClients, slotSize), np.dtype(np.float32)),
+        }
+        self.blocks = []
+        layout = {}
+        for name, (shape, dtype) in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            self.blocks.append(shm)
+            layout[name] = (shm.name, shape, dtype.str)
+
+        self.requests = ctx.Queue()
+        done = [ctx.Event() for _ in range(numClients)]
+        self.failed = ctx.Event()
+        self.clients = [InferenceClient(c, layout, self.requests, done, self.failed, slotSize)
+                        for c in range(numClients)]
+        self.process = ctx.Process(target=serve, daemon=True,
+                                   args=(game, nnetClass, checkpoint, layout, self.requests, done, self.failed,
+                                         maxBatchSize or numClients * slotSize, maxWait,
+                                         numThreads or mp.cpu_count()))
+        self.process.start()
+
+    def close(self):
+        """
+        Stops the server process and frees the shared memory.
+        """
+        self.requests.put(None)
+        self.process.join()
+        for client in self.clients:
+            if client.blocks is not None:
+                client.slots = None
+                for shm in client.blocks:
+                    shm.close()
+                client.blocks = None
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,70 +1,857 @@
+import json
 import logging
 import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 EPS = 1e-8
+NODE_OVERHEAD = 256  # rough number of bytes a node costs besides its child arrays
 
 log = logging.getLogger(__name__)
 
 
+class SearchStats():
+    """
+    Counters and timers of one getActionProb call or searchLeaves search.
+    gameTime is the time spent in the game (board keys, terminal checks,
+    moves and valid actions), nnetTime the time spent waiting for the neural
+    network, summed over the threads of a threaded search.
+    """
+
+    def __init__(self):
+        self.sims = 0  # simulations that were backed up
+        self.simsSaved = 0  # simulations skipped by the early stop
+        self.nnetCalls = 0  # calls to nnet.predict or nnet.predictBatch
+        self.nnetEvals = 0  # boards evaluated by the neural network
+        self.terminalHits = 0  # descents that ended in a terminal board
+        self.solvedHits = 0  # descents that ended in a proven, non-terminal board
+        self.cacheHits = 0  # leaves expanded from the evaluation cache
+        self.transpositions = 0  # new edges that led to a board already in the tree
+        self.cycleCutoffs = 0  # descents that ran into a board already on their path
+        self.maxDepth = 0
+        self.depthSum = 0
+        self.gameTime = 0.
+        self.nnetTime = 0.
+        self.totalTime = 0.
+
+    @property
+    def avgDepth(self):
+        return self.depthSum / self.sims if self.sims else 0.
+
+    def asDict(self):
+        """
+        Returns:
+            stats: the counters and timers, and avgDepth, as a plain dict
+        """
+        stats = dict(vars(self))
+        stats['avgDepth'] = self.avgDepth
+        return stats
+
+    def __repr__(self):
+        return f'{self.sims} sims ({self.simsSaved} saved), {self.nnetEvals} evals in {self.nnetCalls} calls, ' \
+               f'{self.terminalHits} terminal, {self.solvedHits} solved, {self.cacheHits} cache hits, {self.transpositions} transpositions, ' \
+               f'{self.cycleCutoffs} cycles, ' \
+               f'depth {self.avgDepth:.1f} avg / {self.maxDepth} max, ' \
+               f'game {self.gameTime:.3f}s, nnet {self.nnetTime:.3f}s, total {self.totalTime:.3f}s'
+
+
 class MCTS():
     """
     This class handles the MCTS tree.
+
+    Every board reached by the search gets an integer node id the first time it
+    is seen. The children of an expanded node live in contiguous numpy arrays
+    that are aligned with each other: As[s] holds the valid action ids, Ps[s]
+    their priors, Nsa[s] their visit counts and Wsa[s] the sum of the values
+    backed up through them, so that Q(s,a) = Wsa[s][i] / Nsa[s][i]. Csa[s]
+    holds the node ids of the children that have been reached so far.
+
+    Game results are proven bottom-up as in the MCTS-solver (Winands et al.,
+    2008). Ss[s] is the proven value of node s for the player to move, 0 if
+    it is not proven yet, and Ssa[s] the proven values of the children of s
+    from the point of view of s. A node is proven won once one of its
+    children is proven lost for the opponent, and proven once all of its
+    children are, with the best of their values. Terminal nodes are proven
+    by their result. Descents stop at proven nodes, proven children are never
+    selected, and the search stops as soon as the root is proven.
+
+    With progressive widening, enabled by args.pwC, the children of a node
+    are ordered by decreasing prior when it is expanded, and only the first
+    k(N) = ceil(pwC * N**pwAlpha) of them (pwAlpha defaults to 0.5) can be
+    selected once the node has been visited N times. The cost of selection
+    then grows with the visits of a node instead of its number of actions.
+
+    The tree is rooted at the board of the last getActionProb call. Moving the
+    root to a descendant, either with advance() or by calling getActionProb on
+    a board that is already in the tree, keeps the statistics of the subtree
+    below the new root and frees everything else.
+
+    The size of the tree can be bounded with args.mctsMaxNodes and/or
+    args.mctsMaxBytes. Once a bound is exceeded the least recently touched
+    subtrees below the root are evicted, see evict.
+
+    If an evalCache (see EvalCache) is given, leaves are looked up there
+    before they are sent to the network and new evaluations are added to it.
+    Its entries are keyed by modelVersion, which must differ between the
+    networks that share the cache.
+
+    The counters and timers of the last getActionProb call are kept in stats,
+    see SearchStats. If args.mctsStatsFile is set they are also appended to
+    that file as one JSON object per line.
     """
 
-    def __init__(self, game, nnet, args):
+    # the tables that hold one entry per node id
+    nodeTables = ('keys', 'Es', 'Ss', 'Ns', 'Vs', 'As', 'Ps', 'Nsa', 'Wsa', 'Csa', 'Ssa', 'Ts')
+
+    def __init__(self, game, nnet, args, evalCache=None, modelVersion=0):
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}  # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}  # stores #times edge s,a was visited
-        self.Ns = {}  # stores #times board s was visited
-        self.Ps = {}  # stores initial policy (returned by neural net)
+        self.evalCache = evalCache
+        self.modelVersion = modelVersion
+        self.reset()
+        self.simsSaved = 0  # simulations skipped by the early stop of the last getActionProb call
+        self.totalSimsSaved = 0
+        self.selectedAction = None  # action picked by the last Gumbel root search
+        self.stats = SearchStats()  # counters and timers of the last getActionProb call
 
-        self.Es = {}  # stores game.getGameEnded ended for board s
-        self.Vs = {}  # stores game.getValidMoves for board s
-        self.repetitionCounter = {} # stores the number of times a board has been repeated in the current search
+    def reset(self):
+        """
+        Discards the whole tree.
+        """
+        self.nodes = {}  # maps the key of a board (see getKey) to its node id
+        self.root = None  # node id of the board of the last getActionProb call
+        self.rootBoard = None
+
+        self.keys = []  # stores the key of node s
+        self.Es = []  # stores game.getGameEnded ended for node s
+        self.Ss = []  # stores the proven value of node s, 0 if not proven
+        self.Ns = []  # stores #times node s was visited
+        self.Vs = []  # stores the value of node s predicted by the neural net (None until expanded)
+        self.As = []  # stores the valid action ids of node s (None until expanded)
+        self.Ps = []  # stores initial policy (returned by neural net) for As[s]
+        self.Nsa = []  # stores #times edge s,a was visited for As[s]
+        self.Wsa = []  # stores the sum of the values backed up through edge s,a for As[s]
+        self.Csa = []  # stores the child node ids of the edges s,a for As[s], -1 if not reached yet
+        self.Ssa = []  # stores the proven values of the children of s for As[s], for the player of s
+        self.Ts = []  # stores the simulation in which node s was last touched
+        self.tick = 0  # number of descents so far, the clock of Ts
+        self.numBytes = 0  # estimated memory held by the tree
 
-    def getActionProb(self, canonicalBoard, temp=1):
+    def getActionProb(self, canonicalBoard, temp=1, timeBudget=None, minSims=0, maxSims=None, earlyStop=None,
+                      numMCTSSims=None, sparse=False):
         """
-        This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        This function performs MCTS simulations starting from canonicalBoard
+        until its node has been visited numMCTSSims times, args.numMCTSSims
+        unless numMCTSSims is given. Visits inherited
+        from an earlier search, when canonicalBoard is already in the tree,
+        count towards that budget. If args.mctsBatchSize is larger than 1 the
+        leaves are evaluated in batches of that size, see searchBatch. If
+        args.numSearchThreads is larger than 1 that many threads search the
+        tree together, see searchThreaded.
+
+        If args.gumbel is set the root actions are chosen by Gumbel sequential
+        halving instead, see gumbelSearch. Then the returned policy is the
+        improved policy for temp > 0 and the action picked by the search, also
+        stored in selectedAction, for temp=0; timeBudget and earlyStop do not
+        apply.
+
+        If timeBudget is given numMCTSSims is ignored and the search runs for
+        timeBudget seconds instead, but at least minSims and at most maxSims
+        (if given) simulations. The batched search only checks the clock
+        between batches.
+
+        For temp=0 the search stops early when the most visited action can no
+        longer be overtaken within the remaining simulations, if earlyStop is
+        True or, when it is None, if args.mctsEarlyStop is set. The number of
+        simulations that were skipped is stored in simsSaved.
+
+        With sparse=True the policy is returned as an (actions, probs) pair,
+        see sparsePolicy, instead of a dense vector.
 
         Returns:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
-        for i in range(self.args.numMCTSSims):
-            self.search(canonicalBoard)
-            self.repetitionCounter.clear()
+        self.stats = SearchStats()
+        start = time.perf_counter()
+        s = self.setRoot(canonicalBoard)
+        if numMCTSSims is None:
+            numMCTSSims = self.args.numMCTSSims
+        if getattr(self.args, 'gumbel', False):
+            policy = self.gumbelSearch(canonicalBoard, numMCTSSims - self.Ns[s])
+            self.recordStats(start)
+            proven = self.solvedPolicy(temp, sparse=True)
+            if proven is not None:
+                policy = proven
+                self.selectedAction = int(np.random.choice(policy[0]))
+            elif temp == 0 and self.selectedAction is not None:
+                policy = (np.array([self.selectedAction], dtype=np.int32), np.ones(1))
+            return policy if sparse else self.densePolicy(policy)
+
+        if timeBudget is None:
+            numSims = numMCTSSims - self.Ns[s]
+            deadline = None
+        else:
+            numSims = maxSims if maxSims is not None else math.inf
+            deadline = time.perf_counter() + timeBudget
+        if earlyStop is None:
+            earlyStop = getattr(self.args, 'mctsEarlyStop', False)
+        earlyStop = earlyStop and temp == 0 and numSims < math.inf
 
-        s = self.game.stringRepresentation(canonicalBoard)
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(self.game.getActionSize())]
+        if getattr(self.args, 'numSearchThreads', 1) > 1:
+            sims = self.searchThreaded(canonicalBoard, numSims, deadline, minSims, earlyStop)
+        elif getattr(self.args, 'mctsBatchSize', 1) > 1:
+            sims = self.searchBatch(canonicalBoard, numSims, deadline, minSims, earlyStop)
+        else:
+            sims = 0
+            while self.budgetLeft(sims, numSims, deadline, minSims) and self.Ss[self.root] == 0:
+                if earlyStop and self.decided(numSims - sims):
+                    break
+                self.search(canonicalBoard)
+                sims += 1
+                if self.overBudget():
+                    self.evict()
 
+        self.simsSaved = 0
+        if (earlyStop or self.Ss[self.root] != 0) and sims < numSims < math.inf:
+            self.simsSaved = numSims - sims
+            self.totalSimsSaved += self.simsSaved
+            log.debug(f"Root decision settled, skipped {self.simsSaved} simulations.")
+        self.stats.simsSaved = self.simsSaved
+        self.recordStats(start)
+
+        return self.rootPolicy(temp, sparse)
+
+    def rootPolicy(self, temp, sparse=False):
+        """
+        The sparse policy is built from the child arrays of the root alone,
+        so its cost does not depend on game.getActionSize().
+
+        Returns:
+            probs: the policy at the root after a search, the proven best
+                   actions if there are any (see solvedPolicy) and the visit
+                   counts of the root actions otherwise (see countsPolicy), as
+                   an (actions, probs) pair if sparse
+        """
+        policy = self.solvedPolicy(temp, sparse=True)
+        if policy is None:
+            s = self.root
+            if self.As[s] is None or len(self.As[s]) == 0:
+                policy = (np.zeros(0, dtype=np.int32), np.zeros(0))
+            else:
+                probs = self.countsPolicy(self.Nsa[s].astype(np.float64), temp)
+                visited = np.flatnonzero(probs)
+                policy = (self.As[s][visited].astype(np.int32), probs[visited])
+        return policy if sparse else self.densePolicy(policy)
+
+    def densePolicy(self, policy):
+        """
+        Returns:
+            probs: the sparse (actions, probs) policy as a policy vector
+        """
+        actions, probs = policy
+        dense = np.zeros(self.game.getActionSize())
+        dense[actions] = probs
+        return dense
+
+    def rootCounts(self):
+        """
+        Returns:
+            actions: the actions of the root
+            counts: their visit counts
+        """
+        s = self.root
+        if self.As[s] is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return self.As[s], self.Nsa[s]
+
+    @staticmethod
+    def countsPolicy(counts, temp):
+        """
+        Returns:
+            probs: a policy vector where the probability of the ith action is
+                   proportional to counts[i]**(1./temp), for temp=0 all
+                   weight is on one of the most visited actions
+        """
         if temp == 0:
             bestAs = np.array(np.argwhere(counts == np.max(counts))).flatten()
             bestA = np.random.choice(bestAs)
-            probs = [0] * len(counts)
+            probs = np.zeros(len(counts))
             probs[bestA] = 1
             return probs
 
-        counts = [x ** (1. / temp) for x in counts]
-        counts_sum = float(sum(counts))
-        probs = [x / counts_sum for x in counts]
+        counts = counts ** (1. / temp)
+        probs = counts / float(np.sum(counts))
         return probs
 
-    def search(self, canonicalBoard):
+    @staticmethod
+    def sparsePolicy(probs):
         """
-        This function performs one iteration of MCTS. It is recursively called
-        till a leaf node is found. The action chosen at each node is one that
-        has the maximum upper confidence bound as in the paper.
+        Returns:
+            actions: the actions with a nonzero probability in the policy
+                     vector probs, as int32
+            probs: their probabilities
+        """
+        probs = np.asarray(probs)
+        actions = np.flatnonzero(probs).astype(np.int32)
+        return actions, probs[actions]
+
+    def recordStats(self, start):
+        """
+        Completes stats for a getActionProb call that started at start, in
+        time.perf_counter() seconds, and appends them to args.mctsStatsFile if
+        that is set.
+        """
+        self.stats.totalTime = time.perf_counter() - start
+        log.debug(f"MCTS: {self.stats}")
+        statsFile = getattr(self.args, 'mctsStatsFile', None)
+        if statsFile:
+            with open(statsFile, 'a') as f:
+                f.write(json.dumps(self.stats.asDict()) + '\n')
+
+    def solvedPolicy(self, temp, sparse=False):
+        """
+        Returns:
+            probs: if the root is proven won or drawn, a policy vector that is
+                   uniform over the actions that achieve the proven value, or
+                   for temp=0 puts all weight on one of them, as an (actions,
+                   probs) pair if sparse; None otherwise. A proven loss
+                   leaves the choice to the visit counts.
+        """
+        s = self.root
+        if self.Ss[s] == 0 or self.Ss[s] <= -1 or self.As[s] is None:
+            return None
+        best = self.As[s][self.Ssa[s] == self.Ss[s]]
+        if temp == 0:
+            best = np.array([np.random.choice(best)])
+        policy = (best.astype(np.int32), np.full(len(best), 1. / len(best)))
+        return policy if sparse else self.densePolicy(policy)
+
+    def budgetLeft(self, sims, numSims, deadline, minSims):
+        """
+        Returns:
+            True if another simulation should be run after sims of them, given
+            a maximum of numSims and, if deadline is not None, a time limit in
+            time.perf_counter() seconds that applies once minSims are done and
+            an action of the root has been visited
+        """
+        if sims >= numSims:
+            return False
+        if deadline is None or sims < minSims or time.perf_counter() < deadline:
+            return True
+        # without a visited root action there is no policy to return yet
+        return not self.rootVisited()
+
+    def rootVisited(self):
+        """
+        Returns:
+            True if the root is expanded and one of its actions, if it has
+            any, has been visited
+        """
+        s = self.root
+        return self.As[s] is not None and (len(self.As[s]) == 0 or np.sum(self.Nsa[s]) > 0)
+
+    def decided(self, remaining):
+        """
+        Returns:
+            True if the most visited action at the root has more visits than
+            any other action can reach within remaining simulations
+        """
+        visits = self.Nsa[self.root]
+        if visits is None:
+            return False
+        if len(visits) < 2:
+            return True
+        runnerUp, leader = np.partition(visits, len(visits) - 2)[-2:]
+        return leader > runnerUp + remaining
+
+    def setRoot(self, canonicalBoard):
+        """
+        Makes canonicalBoard the root of the tree. If it was reached by an
+        earlier search its subtree is kept, otherwise the tree is discarded.
+
+        Returns:
+            s: the node id of canonicalBoard
+        """
+        s = self.nodes.get(self.getKey(canonicalBoard))
+        if s is None:
+            self.reset()
+        elif s != self.root:
+            self.prune(s)
+        self.root = self.getNode(canonicalBoard)
+        self.rootBoard = canonicalBoard
+        return self.root
+
+    def advance(self, action):
+        """
+        Moves the root of the tree to the child reached by playing action from
+        the board of the last getActionProb call. The visit counts of the
+        chosen subtree are kept as a warm start for the next search, all
+        siblings are freed.
+        """
+        s = self.root
+        if s is None or self.As[s] is None or action not in self.As[s]:
+            self.reset()
+            return
+        i = int(np.flatnonzero(self.As[s] == action)[0])
+        c, board = self.child(s, i, self.rootBoard)
+        self.root = self.prune(c)
+        self.rootBoard = board
 
-        Once a leaf node is found, the neural network is called to return an
+    def prune(self, root, allowed=None):
+        """
+        Drops every node that cannot be reached from root and renumbers the
+        remaining ones so that their tables stay contiguous. If allowed is
+        given, a boolean array over the node ids, the nodes where it is False
+        are dropped together with everything only reachable through them. The
+        edge statistics leading to a dropped node are kept by its parent.
+
+        Returns:
+            root: the new node id of root, which is always 0
+        """
+        keep = [root]
+        seen = {root}
+        for s in keep:
+            if self.Csa[s] is not None:
+                for c in self.Csa[s]:
+                    if c >= 0 and c not in seen and (allowed is None or allowed[c]):
+                        seen.add(c)
+                        keep.append(c)
+
+        newIds = np.full(len(self.Es), -1, dtype=np.int64)
+        newIds[keep] = np.arange(len(keep))
+        for name in self.nodeTables:
+            table = getattr(self, name)
+            setattr(self, name, [table[s] for s in keep])
+        for children in self.Csa:
+            if children is not None:
+                reached = children >= 0
+                children[reached] = newIds[children[reached]]
+        self.nodes = {key: s for s, key in enumerate(self.keys)}
+        self.numBytes = sum(self.nodeBytes(s) for s in range(len(self.Es)))
+        self.root = 0
+        return 0
+
+    def nodeBytes(self, s):
+        """
+        Returns:
+            n: the estimated number of bytes held by node s
+        """
+        n = NODE_OVERHEAD
+        if self.As[s] is not None:
+            n += self.As[s].nbytes + self.Ps[s].nbytes + self.Nsa[s].nbytes + self.Wsa[s].nbytes + self.Csa[s].nbytes + self.Ssa[s].nbytes
+        return n
+
+    def overBudget(self):
+        """
+        Returns:
+            True if the tree holds more nodes than args.mctsMaxNodes or more
+            bytes than args.mctsMaxBytes
+        """
+        maxNodes = getattr(self.args, 'mctsMaxNodes', None)
+        maxBytes = getattr(self.args, 'mctsMaxBytes', None)
+        return (maxNodes is not None and len(self.Es) > maxNodes) or \
+               (maxBytes is not None and self.numBytes > maxBytes)
+
+    def evict(self):
+        """
+        Frees the least recently touched nodes, and the subtrees below them,
+        until the tree is back under args.mctsEvictTarget (default 0.9) of its
+        node and byte budgets. The root is never evicted.
+        """
+        target = getattr(self.args, 'mctsEvictTarget', 0.9)
+        maxNodes = getattr(self.args, 'mctsMaxNodes', None) or float('inf')
+        maxBytes = getattr(self.args, 'mctsMaxBytes', None) or float('inf')
+        numNodes = len(self.Es)
+        numBytes = self.numBytes
+
+        allowed = np.ones(numNodes, dtype=bool)
+        for s in np.argsort(self.Ts, kind='stable'):
+            if numNodes <= target * maxNodes and numBytes <= target * maxBytes:
+                break
+            if s == self.root:
+                continue
+            allowed[s] = False
+            numNodes -= 1
+            numBytes -= self.nodeBytes(s)
+
+        log.debug(f"Evicting {len(self.Es) - numNodes} least recently touched MCTS nodes.")
+        self.prune(self.root, allowed)
+
+    def getKey(self, canonicalBoard):
+        """
+        Returns:
+            key: game.hashKey of canonicalBoard, or its stringRepresentation
+                 for games that do not derive from Game
+        """
+        if hasattr(self.game, 'hashKey'):
+            return self.game.hashKey(canonicalBoard)
+        return self.game.stringRepresentation(canonicalBoard)
+
+    def getNode(self, canonicalBoard):
+        """
+        Returns:
+            s: the node id of canonicalBoard, a new node is added to the table
+               if the board has not been seen before.
+        """
+        start = time.perf_counter()
+        key = self.getKey(canonicalBoard)
+        s = self.nodes.get(key)
+        if s is None:
+            s = len(self.Es)
+            self.nodes[key] = s
+            self.keys.append(key)
+            self.Es.append(self.game.getGameEnded(canonicalBoard, 1))
+            self.Ss.append(self.Es[s])
+            self.Ns.append(0)
+            self.Vs.append(None)
+            self.As.append(None)
+            self.Ps.append(None)
+            self.Nsa.append(None)
+            self.Wsa.append(None)
+            self.Csa.append(None)
+            self.Ssa.append(None)
+            self.Ts.append(self.tick)
+            self.numBytes += NODE_OVERHEAD
+        self.stats.gameTime += time.perf_counter() - start
+        return s
+
+    def child(self, s, i, canonicalBoard):
+        """
+        Plays the action As[s][i] on canonicalBoard, the board of node s.
+
+        Returns:
+            c: the node id of the resulting board
+            board: the resulting board in canonical form
+        """
+        start = time.perf_counter()
+        next_s, next_player = self.game.getNextState(canonicalBoard, 1, self.As[s][i])
+        board = self.game.getCanonicalForm(next_s, next_player)
+        self.stats.gameTime += time.perf_counter() - start
+        c = self.Csa[s][i]
+        if c < 0:
+            numNodes = len(self.Es)
+            c = self.getNode(board)
+            if c < numNodes:
+                self.stats.transpositions += 1
+            self.Csa[s][i] = c
+        return c, board
+
+    def expand(self, s, canonicalBoard, pi, v):
+        """
+        Stores the masked and renormalized prior pi and the value v, as
+        returned by the neural network for canonicalBoard, for the leaf node s.
+        With progressive widening the actions are ordered by decreasing prior.
+        """
+        start = time.perf_counter()
+        actions = self.validActions(canonicalBoard)
+        self.stats.gameTime += time.perf_counter() - start
+        priors = np.asarray(pi)[actions].astype(np.float32)
+        sum_Ps_s = np.sum(priors)
+        if sum_Ps_s > 0:
+            priors /= sum_Ps_s  # renormalize
+        else:
+            # if all valid moves were masked make all valid moves equally probable
+
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            log.error("All valid moves were masked, doing a workaround.")
+            priors = np.full(len(actions), 1. / max(len(actions), 1), dtype=np.float32)
+
+        if getattr(self.args, 'pwC', None):
+            order = np.argsort(-priors, kind='stable')
+            actions, priors = actions[order], priors[order]
+
+        v = np.asarray(v).item()
+        self.setChildren(s, actions, priors, v)
+        if self.evalCache is not None:
+            self.evalCache.put((self.modelVersion, self.keys[s]), (actions, priors, v))
+
+    def expandFromCache(self, s):
+        """
+        Expands the leaf node s from evalCache if its evaluation is cached.
+
+        Returns:
+            v: the cached value of s, or None if s was not expanded
+        """
+        if self.evalCache is None:
+            return None
+        entry = self.evalCache.get((self.modelVersion, self.keys[s]))
+        if entry is None:
+            return None
+        actions, priors, v = entry
+        self.stats.cacheHits += 1
+        self.setChildren(s, actions, priors, v)
+        return v
+
+    def setChildren(self, s, actions, priors, v):
+        """
+        Creates the child arrays of node s for the valid actions with their
+        priors, and stores the network value v of s. actions and priors may
+        be shared with the evaluation cache and are never modified.
+        """
+        self.Vs[s] = v
+        self.As[s] = actions
+        self.Ps[s] = priors
+        self.Nsa[s] = np.zeros(len(actions), dtype=np.int32)
+        self.Wsa[s] = np.zeros(len(actions), dtype=np.float64)
+        self.Csa[s] = np.full(len(actions), -1, dtype=np.int64)
+        self.Ssa[s] = np.zeros(len(actions), dtype=np.float64)
+        self.numBytes += self.nodeBytes(s) - NODE_OVERHEAD
+
+    def validActions(self, canonicalBoard):
+        """
+        Returns:
+            actions: the sorted indices of the valid actions of canonicalBoard,
+                     only the legal actions are ever stored per node.
+        """
+        if hasattr(self.game, 'getValidActions'):
+            return np.asarray(self.game.getValidActions(canonicalBoard, 1), dtype=np.int64)
+        return np.flatnonzero(self.game.getValidMoves(canonicalBoard, 1))
+
+    def selectLeaf(self, canonicalBoard, virtualLoss=0, rootIndex=None):
+        """
+        Descends from canonicalBoard along the actions with the highest upper
+        confidence bound until a leaf, a terminal or proven node, or a node that
+        is already on the path is reached. Every edge on the way receives a
+        virtual loss of virtualLoss visits that each count as a lost game, so
+        that the next descent of the same batch is steered towards other leaves.
+        If rootIndex is given the descent starts with the action As[s][rootIndex]
+        of the (expanded) node s of canonicalBoard.
+
+        Returns:
+            path: the list of (s, i) edges that were followed, i indexes As[s]
+            s: the node id the descent stopped at
+            board: the canonical board of s
+            cycle: True if the descent stopped because s is already on path
+        """
+        self.tick += 1
+        path = []
+        onPath = set()
+        board = canonicalBoard
+        s = self.getNode(board)
+        while True:
+            self.Ts[s] = self.tick
+            if s in onPath:
+                log.debug("Cycle detected: state repeated on the search path. Returning 0.")
+                self.stats.cycleCutoffs += 1
+                return path, s, board, True
+            if self.Ss[s] != 0:
+                if self.Es[s] != 0:
+                    self.stats.terminalHits += 1
+                else:
+                    self.stats.solvedHits += 1
+                return path, s, board, False
+            if self.As[s] is None:
+                return path, s, board, False
+            onPath.add(s)
+
+            if rootIndex is not None:
+                i, rootIndex = rootIndex, None
+            else:
+                i = self.selectChild(s)
+            self.Nsa[s][i] += virtualLoss
+            self.Wsa[s][i] -= virtualLoss
+            self.Ns[s] += virtualLoss
+            path.append((s, i))
+            s, board = self.child(s, i, board)
+
+    def revertVirtualLoss(self, path, virtualLoss):
+        """
+        Removes the virtual loss that selectLeaf added along path without
+        recording a visit.
+        """
+        for s, i in path:
+            self.Nsa[s][i] -= virtualLoss
+            self.Wsa[s][i] += virtualLoss
+            self.Ns[s] -= virtualLoss
+
+    def backup(self, path, v, virtualLoss=0):
+        """
+        Propagates the value v of the last node of path up to the root and
+        removes the virtual loss that selectLeaf added to every edge. Proven
+        values are propagated along path as far as they prove its nodes.
+
+        Returns:
+            v: the value of the first node of path
+        """
+        self.stats.sims += 1
+        self.stats.depthSum += len(path)
+        self.stats.maxDepth = max(self.stats.maxDepth, len(path))
+        v = np.asarray(v).item()
+        proving = True
+        for s, i in reversed(path):
+            v = -v
+            self.Nsa[s][i] += 1 - virtualLoss
+            self.Wsa[s][i] += v + virtualLoss
+            self.Ns[s] += 1 - virtualLoss
+            if proving:
+                proving = self.prove(s, i)
+        return v
+
+    def prove(self, s, i):
+        """
+        Records the proven value of the child As[s][i] of s, if it has one,
+        and proves s if that settles it.
+
+        Returns:
+            True if s is proven
+        """
+        c = self.Csa[s][i]
+        if c < 0 or self.Ss[c] == 0:
+            return False
+        self.Ssa[s][i] = -self.Ss[c]
+        best = np.max(self.Ssa[s])
+        if best >= 1 or np.all(self.Ssa[s] != 0):
+            self.Ss[s] = best
+        return self.Ss[s] != 0
+
+    def searchBatch(self, canonicalBoard, numSims, deadline=None, minSims=0, earlyStop=False):
+        """
+        Performs numSims simulations of MCTS starting from canonicalBoard,
+        evaluating up to args.mctsBatchSize leaves with one call to
+        nnet.predictBatch. A round of leaf collection ends early when a descent
+        reaches a leaf that is already waiting for the network, that descent
+        is undone and does not count as a simulation. If a deadline is given
+        no new round is started after it once minSims are done, see budgetLeft.
+        With earlyStop no new round is started once the root decision can no
+        longer change, see decided.
+
+        Returns:
+            sims: the number of simulations that were run
+        """
+        batchSize = self.args.mctsBatchSize
+        virtualLoss = getattr(self.args, 'virtualLoss', 1)
+        sims = 0
+        while self.budgetLeft(sims, numSims, deadline, minSims) and self.Ss[self.root] == 0:
+            if earlyStop and self.decided(numSims - sims):
+                break
+            pending = {}  # leaf node id -> (board, path leading to it)
+            while sims < numSims and len(pending) < batchSize and self.Ss[self.root] == 0:
+                path, s, board, cycle = self.selectLeaf(canonicalBoard, virtualLoss)
+                if s in pending:
+                    self.revertVirtualLoss(path, virtualLoss)
+                    break
+                sims += 1
+                if cycle:
+                    # the descent ran into a cycle, treat it as a draw
+                    self.backup(path, 0, virtualLoss)
+                elif self.Ss[s] != 0:
+                    self.backup(path, self.Ss[s], virtualLoss)
+                else:
+                    v = self.expandFromCache(s)
+                    if v is None:
+                        pending[s] = (board, path)
+                    else:
+                        self.backup(path, v, virtualLoss)
+
+            if not pending:
+                continue
+            leaves = list(pending)
+            start = time.perf_counter()
+            pis, vs = self.nnet.predictBatch([pending[s][0] for s in leaves])
+            self.stats.nnetTime += time.perf_counter() - start
+            self.stats.nnetCalls += 1
+            self.stats.nnetEvals += len(leaves)
+            for s, pi, v in zip(leaves, pis, vs):
+                board, path = pending[s]
+                self.expand(s, board, pi, v)
+                self.backup(path, v, virtualLoss)
+            if self.overBudget():
+                self.evict()
+        return sims
+
+    def searchThreaded(self, canonicalBoard, numSims, deadline=None, minSims=0, earlyStop=False):
+        """
+        Performs numSims simulations of MCTS starting from canonicalBoard with
+        args.numSearchThreads threads that share the tree. A thread holds the
+        tree lock while it descends, expands and backs up, and releases it
+        while nnet.predict evaluates its leaf, which is where the GIL is
+        released as well. Virtual loss on the descended edges spreads the
+        threads over different leaves, and a thread whose leaf is already
+        being evaluated by another thread waits for that evaluation instead.
+        Deadline, minSims and earlyStop work as in searchBatch; the tree is
+        only evicted once all threads are done.
+
+        Returns:
+            sims: the number of simulations that were run
+        """
+        virtualLoss = getattr(self.args, 'virtualLoss', 1)
+        treeChanged = threading.Condition()
+        pending = set()  # leaves that are being evaluated
+        started = [0]
+
+        def worker():
+            while True:
+                with treeChanged:
+                    if not self.budgetLeft(started[0], numSims, deadline, minSims) or self.Ss[self.root] != 0:
+                        return
+                    if earlyStop and self.decided(numSims - started[0]):
+                        return
+                    path, s, board, cycle = self.selectLeaf(canonicalBoard, virtualLoss)
+                    if s in pending:
+                        self.revertVirtualLoss(path, virtualLoss)
+                        treeChanged.wait()
+                        continue
+                    started[0] += 1
+                    if cycle or self.Ss[s] != 0:
+                        self.backup(path, 0 if cycle else self.Ss[s], virtualLoss)
+                        treeChanged.notify_all()
+                        continue
+                    v = self.expandFromCache(s)
+                    if v is not None:
+                        self.backup(path, v, virtualLoss)
+                        treeChanged.notify_all()
+                        continue
+                    pending.add(s)
+
+                try:
+                    start = time.perf_counter()
+                    pi, v = self.nnet.predict(board)
+                    nnetTime = time.perf_counter() - start
+                except BaseException:
+                    with treeChanged:
+                        self.revertVirtualLoss(path, virtualLoss)
+                        pending.discard(s)
+                        treeChanged.notify_all()
+                    raise
+
+                with treeChanged:
+                    self.stats.nnetTime += nnetTime
+                    self.stats.nnetCalls += 1
+                    self.stats.nnetEvals += 1
+                    self.expand(s, board, pi, v)
+                    self.backup(path, v, virtualLoss)
+                    pending.discard(s)
+                    treeChanged.notify_all()
+
+        numThreads = self.args.numSearchThreads
+        with ThreadPoolExecutor(max_workers=numThreads) as executor:
+            for future in [executor.submit(worker) for _ in range(numThreads)]:
+                future.result()
+
+        if self.overBudget():
+            self.evict()
+        return started[0]
+
+    def search(self, canonicalBoard, rootIndex=None):
+        """
+        This function performs one iteration of MCTS. It descends from
+        canonicalBoard until a leaf node is found. The action chosen at each node is one that
+        has the maximum upper confidence bound as in the paper, except at the
+        root if rootIndex is given (see selectLeaf).
+
+        Once a leaf node is found, the neural network (or the evaluation cache,
+        if the leaf is in it) is called to return an
         initial policy P and a value v for the state. This value is propagated
         up the search path. In case the leaf node is a terminal state, the
-        outcome is propagated up the search path. The values of Ns, Nsa, Qsa are
-        updated.
+        outcome is propagated up the search path. If the descent returns to a
+        board that is already on its path the cycle is cut off and a neutral
+        value of 0 is propagated. The values of Ns, Nsa, Wsa are updated.
 
         NOTE: the return values are the negative of the value of the current
         state. This is done since v is in [-1,1] and if v is the value of a
@@ -73,75 +860,191 @@ class MCTS():
         Returns:
             v: the negative of the value of the current canonicalBoard
         """
+        path, s, board, cycle = self.selectLeaf(canonicalBoard, rootIndex=rootIndex)
 
-        s = self.game.stringRepresentation(canonicalBoard)
-
-        # Track repetitions
-        if s not in self.repetitionCounter:
-            self.repetitionCounter[s] = 1
+        if cycle:
+            v = 0  # Neutral value to break the cycle
+        elif self.Ss[s] != 0:
+            # terminal or proven node
+            v = self.Ss[s]
         else:
-            self.repetitionCounter[s] += 1
-            if self.repetitionCounter[s] >= 6:  # Arbitrary threshold to detect cycles
-                log.warning(f"Cycle detected: state repeated {self.repetitionCounter[s]} times. Returning 0.")
-                return 0  # Neutral value to break infinite cycle
-
-        if s not in self.Es:
-            self.Es[s] = self.game.getGameEnded(canonicalBoard, 1)
-        if self.Es[s] != 0:
-            # terminal node
-            return -self.Es[s]
-
-        if s not in self.Ps:
             # leaf node
-            self.Ps[s], v = self.nnet.predict(canonicalBoard)
-            valids = self.game.getValidMoves(canonicalBoard, 1)
-            self.Ps[s] = self.Ps[s] * valids  # masking invalid moves
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s  # renormalize
+            v = self.expandFromCache(s)
+            if v is None:
+                start = time.perf_counter()
+                pi, v = self.nnet.predict(board)
+                self.stats.nnetTime += time.perf_counter() - start
+                self.stats.nnetCalls += 1
+                self.stats.nnetEvals += 1
+                self.expand(s, board, pi, v)
+
+        return -self.backup(path, v)
+
+    def searchLeaves(self, canonicalBoard, numMCTSSims=None):
+        """
+        A generator that runs the search of getActionProb from canonicalBoard
+        (up to numMCTSSims, by default args.numMCTSSims, root visits) but
+        leaves the network to its caller. It yields every leaf board that
+        needs an evaluation and expects the (pi, v) of that board to be sent
+        back. This lets one caller drive the searches of many trees and
+        evaluate their leaves together, see Coach.executeEpisodesLockstep.
+        Once it is exhausted, rootPolicy gives the policy.
+
+        Every yield counts as a network call in stats, and the time until
+        the evaluation is sent back as nnetTime, so in lockstep it includes
+        the turns of the other games.
+        """
+        self.stats = SearchStats()
+        start = time.perf_counter()
+        s = self.setRoot(canonicalBoard)
+        if numMCTSSims is None:
+            numMCTSSims = self.args.numMCTSSims
+        numSims = numMCTSSims - self.Ns[s]
+        sims = 0
+        while sims < numSims and self.Ss[self.root] == 0:
+            path, s, board, cycle = self.selectLeaf(canonicalBoard)
+            sims += 1
+            if cycle:
+                v = 0
+            elif self.Ss[s] != 0:
+                v = self.Ss[s]
             else:
-                # if all valid moves were masked make all valid moves equally probable
-
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.   
-                log.error("All valid moves were masked, doing a workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return -v
-
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
-
-        # pick the action with the highest upper confidence bound
-        for a in range(self.game.getActionSize()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    u = self.Qsa[(s, a)] + self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s]) / (
-                            1 + self.Nsa[(s, a)])
-                else:
-                    u = self.args.cpuct * self.Ps[s][a] * math.sqrt(self.Ns[s] + EPS)  # Q = 0 ?
+                v = self.expandFromCache(s)
+                if v is None:
+                    nnetStart = time.perf_counter()
+                    pi, v = yield board
+                    self.stats.nnetTime += time.perf_counter() - nnetStart
+                    self.stats.nnetCalls += 1
+                    self.stats.nnetEvals += 1
+                    self.expand(s, board, pi, v)
+            self.backup(path, v)
+            if self.overBudget():
+                self.evict()
+        self.recordStats(start)
 
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
+    def gumbelSearch(self, canonicalBoard, numSims):
+        """
+        Runs numSims simulations from the root canonicalBoard with the Gumbel
+        root search of "Policy improvement by planning with Gumbel" (Danihelka
+        et al., 2022). getActionProb passes the budget left after the visits
+        the root inherited from an earlier search. The args.gumbelActions (default 16) actions with the
+        largest g + logits, with g sampled from Gumbel(0, 1), are kept as
+        candidates. Sequential halving then splits the simulations evenly over
+        the candidates in log2(gumbelActions) phases and halves them after
+        every phase by g + logits + sigma(Q), see sigma. Below the root the
+        search is the usual PUCT. The surviving candidate is stored in
+        selectedAction.
 
-        a = best_act
-        next_s, next_player = self.game.getNextState(canonicalBoard, 1, a)
-        next_s = self.game.getCanonicalForm(next_s, next_player)
+        Returns:
+            policy: the improved policy softmax(logits + sigma(completed Q)) as
+                    an (actions, probs) pair, the training target for the root
+        """
+        s = self.root
+        sims = 0
+        if self.As[s] is None:
+            self.search(canonicalBoard)
+            sims += 1
+        if self.As[s] is None or len(self.As[s]) == 0:
+            # a terminal root is never expanded, there is nothing to choose
+            self.selectedAction = None
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+        if self.Ss[s] != 0:
+            # a proven root, e.g. kept by advance, needs no search; the proven
+            # actions or, for a proven loss, the visit counts decide
+            self.selectedAction = int(np.random.choice(self.rootPolicy(0, sparse=True)[0]))
+            return self.rootPolicy(1, sparse=True)
 
-        v = self.search(next_s)
+        logits = np.log(self.Ps[s].astype(np.float64) + EPS)
+        gumbel = np.random.gumbel(size=len(logits))
+        m = min(getattr(self.args, 'gumbelActions', 16), len(logits))
+        candidates = np.argsort(-(gumbel + logits), kind='stable')[:m]
 
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] * self.Qsa[(s, a)] + v) / (self.Nsa[(s, a)] + 1)
-            self.Nsa[(s, a)] += 1
+        numPhases = max(1, math.ceil(math.log2(m)))
+        budget = numSims - sims
+        for phase in range(numPhases):
+            if phase == numPhases - 1:
+                # the last phase spends whatever the earlier ones left over
+                simsPerAction = math.ceil((numSims - sims) / len(candidates))
+            else:
+                simsPerAction = max(1, budget // (numPhases * len(candidates)))
+            for _ in range(simsPerAction):
+                for i in candidates:
+                    if sims < numSims and self.Ss[s] == 0:
+                        self.search(canonicalBoard, rootIndex=i)
+                        sims += 1
+            scores = gumbel[candidates] + logits[candidates] + self.sigma(s)[candidates]
+            candidates = candidates[np.argsort(-scores, kind='stable')[:max(1, len(candidates) // 2)]]
 
-        else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+        self.selectedAction = int(self.As[s][candidates[0]])
+
+        improved = logits + self.sigma(s)
+        improved = np.exp(improved - np.max(improved))
+        return self.As[s].astype(np.int32), improved / np.sum(improved)
+
+    def completedQ(self, s):
+        """
+        Returns:
+            q: Q(s,a) for the visited children of s and, for the unvisited
+               ones, the mixed value estimate of s that interpolates between
+               the network value Vs[s] and the prior weighted Q of the visited
+               children
+        """
+        visits = self.Nsa[s]
+        priors = self.Ps[s]
+        q = np.divide(self.Wsa[s], visits, out=np.zeros(len(visits)), where=visits > 0)
+        visited = visits > 0
+        sumN = np.sum(visits)
+        vMix = self.Vs[s]
+        if sumN > 0:
+            weightedQ = np.dot(priors[visited], q[visited]) / (np.sum(priors[visited]) + EPS)
+            vMix = (self.Vs[s] + sumN * weightedQ) / (1 + sumN)
+        return np.where(visited, q, vMix)
 
-        self.Ns[s] += 1
-        return -v
+    def sigma(self, s):
+        """
+        Returns:
+            sigma: the monotone transformation (cVisit + max_b N(s,b)) * cScale
+                   * q of the completed Q values of s rescaled to [0, 1], with
+                   cVisit = args.gumbelCVisit (50) and cScale = args.gumbelCScale (1)
+        """
+        cVisit = getattr(self.args, 'gumbelCVisit', 50)
+        cScale = getattr(self.args, 'gumbelCScale', 1.0)
+        q = (self.completedQ(s) + 1) / 2
+        return (cVisit + np.max(self.Nsa[s])) * cScale * q
+
+    def selectChild(self, s):
+        """
+        Picks the child of s with the highest upper confidence bound
+            Q(s,a) + cpuct * P(s,a) * sqrt(N(s)) / (1 + N(s,a))
+        in one vectorized expression over the child arrays of s. Unvisited
+        edges have Q = 0, and sqrt(N(s) + EPS) is used so that the priors still
+        decide while N(s) is 0. Proven children are skipped. Ties go to the
+        lowest index, like a scan that only replaces the best action on a
+        strictly larger bound. With progressive widening only the first
+        numEligible(s) children are considered, unless all of them are proven.
+
+        Returns:
+            i: the index into As[s] of the action with the highest upper
+               confidence bound
+        """
+        for k in (self.numEligible(s), len(self.As[s])):
+            visits = self.Nsa[s][:k]
+            q = np.divide(self.Wsa[s][:k], visits, out=np.zeros(len(visits)), where=visits > 0)
+            u = q + self.args.cpuct * math.sqrt(self.Ns[s] + EPS) * self.Ps[s][:k] / (1 + visits)
+            u[self.Ssa[s][:k] != 0] = -np.inf
+            i = int(np.argmax(u))
+            if u[i] > -np.inf:
+                break
+        return i
+
+    def numEligible(self, s):
+        """
+        Returns:
+            k: the number of children of s that selection considers, all of
+               them unless progressive widening is enabled
+        """
+        c = getattr(self.args, 'pwC', None)
+        if not c:
+            return len(self.As[s])
+        k = math.ceil(c * self.Ns[s] ** getattr(self.args, 'pwAlpha', 0.5))
+        return min(max(k, 1), len(self.As[s]))
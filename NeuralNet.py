@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class NeuralNet():
     """
     This class specifies the base NeuralNet class. To define your own neural
@@ -6,8 +9,13 @@ class NeuralNet():
     the canonical form of the board.
 
     See othello/NNet.py for an example implementation.
+
+    Networks that set sparsePolicy are trained with sparse policies, see
+    train.
     """
 
+    sparsePolicy = False
+
     def __init__(self, game):
         pass
 
@@ -20,7 +28,9 @@ class NeuralNet():
             examples: a list of training examples, where each example is of form
                       (board, pi, v). pi is the MCTS informed policy vector for
                       the given board, and v is its value. The examples has
-                      board in its canonical form.
+                      board in its canonical form. If sparsePolicy is set pi
+                      is an (actions, probs) pair of the actions with a
+                      nonzero probability and their probabilities.
         """
         pass
 
@@ -36,6 +46,24 @@ class NeuralNet():
         """
         pass
 
+    def predictBatch(self, boards):
+        """
+        Input:
+            boards: a list of boards in their canonical form.
+
+        Returns:
+            pis: a numpy array of shape (len(boards), game.getActionSize) with
+                 the policy vector of every board
+            vs: a numpy array of shape (len(boards),) with the values
+
+        Networks that can evaluate several boards in one forward pass should
+        override this, the default simply calls predict once per board.
+        """
+        results = [self.predict(board) for board in boards]
+        pis = np.array([pi for pi, _ in results])
+        vs = np.array([np.asarray(v).reshape(-1)[0] for _, v in results])
+        return pis, vs
+
     def save_checkpoint(self, folder, filename):
         """
         Saves the current neural network (with its parameters) in
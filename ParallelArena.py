@@ -0,0 +1,95 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from Arena import Arena
+from EvalCache import EvalCache
+from MCTS import MCTS
+from utils import setTorchThreads
+
+worker = None  # (game, nnets, args, evalCache) of an arena process, set by initWorker
+
+
+def initWorker(game, nnetClass, args, checkpoints, numThreads):
+    """
+    Builds both networks of an arena process and loads their weights from
+    checkpoints, one (folder, filename) tuple or None per network.
+    """
+    global worker
+    setTorchThreads(numThreads)
+    nnets = []
+    for checkpoint in checkpoints:
+        nnet = nnetClass(game)
+        if checkpoint is not None:
+            nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+        nnets.append(nnet)
+    cacheSize = getattr(args, 'evalCacheSize', 0)
+    worker = (game, nnets, args, EvalCache(cacheSize) if cacheSize > 0 else None)
+
+
+def playGame(seed, swap):
+    """
+    Plays one arena game between the networks of an arena process. Each
+    player searches with its own fresh MCTS, so the game only depends on
+    seed. The first network starts unless swap is set.
+
+    Returns:
+        result: the result of the game for the first network, see
+                Arena.playGame
+    """
+    game, nnets, args, evalCache = worker
+    np.random.seed(seed)
+    players = []
+    for version, nnet in enumerate(nnets):
+        mcts = MCTS(game, nnet, args, evalCache, version)
+        players.append(lambda x, mcts=mcts: np.argmax(mcts.getActionProb(x, temp=0)))
+    if swap:
+        return -Arena(players[1], players[0], game, game.display).playGame()
+    return Arena(players[0], players[1], game, game.display).playGame()
+
+
+class ParallelArena():
+    """
+    An Arena for two networks whose games are played in numWorkers processes
+    (args.numArenaWorkers by default). Every process builds nnetClass(game)
+    twice, loads the weights of checkpoint1 and checkpoint2, (folder,
+    filename) tuples, into them and plays whole games with an MCTS player
+    per network.
+
+    Game i gets the seed seed + i and fresh search trees, so playGames
+    returns the same results for the same seed however the games are spread
+    over the processes.
+    """
+
+    def __init__(self, game, nnetClass, args, checkpoint1, checkpoint2, numWorkers=None, seed=0):
+        self.game = game
+        self.nnetClass = nnetClass
+        self.args = args
+        self.checkpoints = (checkpoint1, checkpoint2)
+        self.numWorkers = numWorkers or getattr(args, 'numArenaWorkers', mp.cpu_count())
+        self.seed = seed
+
+    def playGames(self, num):
+        """
+        Plays num games in which player1, the network of checkpoint1, starts
+        num/2 games and player2 starts num/2 games, like Arena.playGames.
+
+        Returns:
+            oneWon: games won by player1
+            twoWon: games won by player2
+            draws:  games won by nobody
+        """
+        num = int(num / 2)
+        games = [(self.seed + i, i >= num) for i in range(2 * num)]
+        numWorkers = max(1, min(self.numWorkers, len(games)))
+        numThreads = max(1, mp.cpu_count() // numWorkers)
+        with mp.get_context('spawn').Pool(numWorkers, initializer=initWorker,
+                                          initargs=(self.game, self.nnetClass, self.args, self.checkpoints,
+                                                    numThreads)) as pool:
+            results = pool.starmap(playGame, games, chunksize=1)
+
+        oneWon = sum(1 for result in results if result == 1)
+        twoWon = sum(1 for result in results if result == -1)
+        draws = len(results) - oneWon - twoWon
+        print(f"Player 1 won {oneWon} games, Player 2 won {twoWon} games, and there were {draws} draws.\n")
+        return oneWon, twoWon, draws
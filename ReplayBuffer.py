@@ -0,0 +1,142 @@
+import logging
+import os
+import re
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class ReplayBuffer():
+    """
+    An on-disk store of training examples, written as one shard per
+    iteration. A shard is a folder of .npy files:
+        boards:    the boards, stacked into one fixed-shape array
+        piOffsets: where the policy of each example starts in piActions
+        piActions: the actions with a nonzero probability, as int32
+        piProbs:   their probabilities, as float32
+        values:    the values, as float32
+        versions:  the model version of each example, if they are tagged
+    Shards are only ever added, never rewritten, and are opened memory mapped
+    so that opening them costs next to nothing. The buffer holds a sliding
+    window of the last `window` shards.
+
+    The buffer behaves like a list of (board, pi, v) examples, so
+    NeuralNet.train can sample from it directly. The policies are dense
+    vectors, or (actions, probs) pairs if sparse is set.
+    """
+
+    def __init__(self, folder, window, actionSize, sparse=False):
+        self.folder = folder
+        self.window = window
+        self.actionSize = actionSize
+        self.sparse = sparse
+        self.shards = []  # dicts of the memory mapped arrays of the shards in the window
+        self.offsets = np.zeros(1, dtype=np.int64)  # the index of the first example of every shard
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        """
+        Returns:
+            example: the (board, pi, v) of the ith example in the window
+        """
+        shard, j = self.locate(i)
+        start, end = shard['piOffsets'][j], shard['piOffsets'][j + 1]
+        if self.sparse:
+            pi = (np.array(shard['piActions'][start:end]), np.array(shard['piProbs'][start:end]))
+        else:
+            pi = np.zeros(self.actionSize, dtype=np.float32)
+            pi[shard['piActions'][start:end]] = shard['piProbs'][start:end]
+        return np.array(shard['boards'][j]), pi, float(shard['values'][j])
+
+    def version(self, i):
+        """
+        Returns:
+            version: the model version of the ith example, None if untagged
+        """
+        shard, j = self.locate(i)
+        return int(shard['versions'][j]) if 'versions' in shard else None
+
+    def locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        s = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.shards[s], i - int(self.offsets[s])
+
+    def addShard(self, examples):
+        """
+        Writes examples, (board, pi, v) or (board, pi, v, version) tuples, as
+        a new shard of folder and adds it to the window. pi is either a dense
+        policy vector or a sparse (actions, probs) pair.
+        """
+        examples = list(examples)
+        if not examples:
+            return
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        name = f'shard_{self.nextShard():06d}'
+        tmp = os.path.join(self.folder, name + '.tmp')
+        os.makedirs(tmp)
+
+        actions = []
+        probs = []
+        for example in examples:
+            pi = example[1]
+            if not isinstance(pi, tuple):
+                dense = np.asarray(pi, dtype=np.float32)
+                nonzero = np.flatnonzero(dense)
+                pi = (nonzero, dense[nonzero])
+            actions.append(pi[0])
+            probs.append(pi[1])
+        arrays = {
+            'boards': np.array([example[0] for example in examples]),
+            'piOffsets': np.concatenate([[0], np.cumsum([len(a) for a in actions])]).astype(np.int64),
+            'piActions': np.concatenate(actions).astype(np.int32),
+            'piProbs': np.concatenate(probs).astype(np.float32),
+            'values': np.array([example[2] for example in examples], dtype=np.float32),
+        }
+        if len(examples[0]) > 3:
+            arrays['versions'] = np.array([example[3] for example in examples], dtype=np.int64)
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp, key + '.npy'), array)
+        path = os.path.join(self.folder, name)
+        os.replace(tmp, path)
+        self.addToWindow([path])
+
+    def nextShard(self):
+        return max((int(f[len('shard_'):]) for f in self.listShards(self.folder)), default=-1) + 1
+
+    @staticmethod
+    def listShards(folder):
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f for f in os.listdir(folder) if re.match(r'shard_\d+$', f))
+
+    def open(self, folder=None):
+        """
+        Opens the last `window` shards of folder (by default the folder of
+        the buffer) and adds them to the window.
+
+        Returns:
+            n: the number of shards that were opened
+        """
+        folder = folder or self.folder
+        paths = [os.path.join(folder, f) for f in self.listShards(folder)][-self.window:]
+        self.addToWindow(paths)
+        return len(paths)
+
+    def addToWindow(self, paths):
+        for path in paths:
+            shard = {}
+            for f in os.listdir(path):
+                if f.endswith('.npy'):
+                    shard[f[:-4]] = np.load(os.path.join(path, f), mmap_mode='r')
+            self.shards.append(shard)
+        if len(self.shards) > self.window:
+            log.info(f'Dropping the {len(self.shards) - self.window} oldest replay shards from the window.')
+            self.shards = self.shards[-self.window:]
+        self.offsets = np.concatenate([[0], np.cumsum([len(shard['values']) for shard in self.shards])]).astype(np.int64)
@@ -0,0 +1,119 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from EvalCache import EvalCache
+from MCTS import MCTS
+from utils import setTorchThreads
+
+worker = None  # (game, nnet, args, evalCache) of a search process, set by initWorker
+
+
+def initWorker(game, nnetClass, args, checkpoint):
+    """
+    Builds the network of a search process and loads its weights from the
+    checkpoint (folder, filename), if given. The processes are the
+    parallelism, so torch, if it is used, gets a single thread each.
+    """
+    global worker
+    setTorchThreads(1)
+    nnet = nnetClass(game)
+    if checkpoint is not None:
+        nnet.load_checkpoint(folder=checkpoint[0], filename=checkpoint[1])
+    cacheSize = getattr(args, 'evalCacheSize', 0)
+    worker = (game, nnet, args, EvalCache(cacheSize) if cacheSize > 0 else None)
+
+
+def searchRoot(canonicalBoard, seed, kwargs):
+    """
+    Runs one independent search from canonicalBoard in a search process.
+
+    Returns:
+        counts: the actions of the root and their visit counts, see
+                MCTS.rootCounts
+        proven: the sparse policy over the proven best actions if the search
+                proved the root won or drawn, else None
+    """
+    game, nnet, args, evalCache = worker
+    np.random.seed(seed)
+    mcts = MCTS(game, nnet, args, evalCache)
+    mcts.getActionProb(canonicalBoard, temp=1, **kwargs)
+    return mcts.rootCounts(), mcts.solvedPolicy(1, sparse=True)
+
+
+class RootParallelMCTS():
+    """
+    Root parallel MCTS. numWorkers processes (args.numRootWorkers by default)
+    each search their own tree from the same root with their own seed, and the
+    root visit counts of all trees are summed before they are turned into a
+    policy. Apart from that getActionProb behaves like MCTS.getActionProb,
+    with the same keyword arguments, so it can stand in for MCTS in Arena
+    players and the pygame AIPlayer.
+
+    The network is not sent to the processes. Each of them builds its own
+    nnetClass(game) and loads the weights from checkpoint, a (folder,
+    filename) tuple, once when it starts. Every call starts fresh trees, so
+    advance() is a no-op that is only there to keep the MCTS interface.
+
+    The processes are started with spawn, which is safe with torch, and run
+    until close() is called or the object is used as a context manager.
+    """
+
+    def __init__(self, game, nnetClass, args, checkpoint=None, numWorkers=None, seed=0):
+        self.game = game
+        self.args = args
+        self.numWorkers = numWorkers or getattr(args, 'numRootWorkers', mp.cpu_count())
+        self.seed = seed
+        self.numCalls = 0
+        self.pool = mp.get_context('spawn').Pool(self.numWorkers, initializer=initWorker,
+                                                 initargs=(game, nnetClass, args, checkpoint))
+
+    def getActionProb(self, canonicalBoard, temp=1, **kwargs):
+        """
+        Searches canonicalBoard in all processes, see MCTS.getActionProb for
+        the keyword arguments. If one of the searches proves the root won or
+        drawn, its proven actions decide the move. With sparse=True the policy
+        is returned as an (actions, probs) pair, see MCTS.sparsePolicy.
+
+        Returns:
+            probs: a policy vector where the probability of the ith action is
+                   proportional to the summed root visit counts**(1./temp)
+        """
+        sparse = kwargs.pop('sparse', False)
+        seeds = [self.seed + self.numCalls * self.numWorkers + i for i in range(self.numWorkers)]
+        self.numCalls += 1
+        results = self.pool.starmap(searchRoot, [(canonicalBoard, seed, kwargs) for seed in seeds], chunksize=1)
+
+        for _, proven in results:
+            if proven is not None:
+                actions, counts = proven
+                break
+        else:
+            # only the root actions travel back, their counts are summed here
+            actions, inverse = np.unique(np.concatenate([a for (a, _), _ in results]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([n for (_, n), _ in results]),
+                                 minlength=len(actions))
+        probs = MCTS.countsPolicy(np.asarray(counts, dtype=np.float64), temp)
+        visited = np.flatnonzero(probs)
+        policy = (actions[visited].astype(np.int32), probs[visited])
+        if sparse:
+            return policy
+        dense = np.zeros(self.game.getActionSize())
+        dense[policy[0]] = policy[1]
+        return dense
+
+    def advance(self, action):
+        pass
+
+    def close(self):
+        """
+        Stops the search processes.
+        """
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
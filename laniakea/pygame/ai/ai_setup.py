@@ -1,11 +1,19 @@
 import numpy as np
+from MCTS import MCTS
+from RootParallelMCTS import RootParallelMCTS
+from utils import dotdict
 class AIPlayer:
     """
     AI player that uses a neural network to predict moves.
+    If think_time is given, the move is chosen by an MCTS search that runs for
+    think_time seconds instead of taking the best move of the raw policy.
+    With num_workers > 1 that many processes search in parallel and their
+    visit counts are summed, see RootParallelMCTS.
     """
-    def __init__(self, game, player, nnet, name, file=None):
+    def __init__(self, game, player, nnet, name, file=None, think_time=None, num_workers=1):
         self.game = game
         self.nnet = nnet
+        self.think_time = think_time
         # Find first file in the folder
         if file is None:
             import os
@@ -18,6 +26,13 @@ class AIPlayer:
         # Load the neural network model
         self.nnet.load_checkpoint(folder="models/" + name, filename=file)
         self.player = player
+        self.mcts = None
+        if think_time is not None:
+            args = dotdict({'numMCTSSims': 0, 'cpuct': 1.0})
+            if num_workers > 1:
+                self.mcts = RootParallelMCTS(game, nnet.__class__, args, ("models/" + name, file), num_workers)
+            else:
+                self.mcts = MCTS(game, nnet, args)
 
     def get_action(self, board):
         """Get the next action for the AI player."""
@@ -25,16 +40,20 @@ class AIPlayer:
         # Convert board to canonical form
         tensor_board = self.nnet.board_to_tensor(board, self.player)
         can_board = self.game.getCanonicalForm(tensor_board, self.player)
-        pi, v = self.nnet.predict(can_board)
-        valids = self.game.getValidMoves(can_board, 1)
+        if self.mcts is not None:
+            # Search for a fixed time so that every move takes about as long
+            pi = self.mcts.getActionProb(can_board, temp=0, timeBudget=self.think_time, minSims=2)
+        else:
+            pi, v = self.nnet.predict(can_board)
+            valids = self.game.getValidMoves(can_board, 1)
 
-        # Mask invalid moves
-        pi = pi * valids
-        sum_pi = np.sum(pi)
+            # Mask invalid moves
+            pi = pi * valids
+            sum_pi = np.sum(pi)
 
-        #Normalize probabilities
-        if sum_pi > 0:
-            pi /= sum_pi
+            #Normalize probabilities
+            if sum_pi > 0:
+                pi /= sum_pi
 
         move = np.argmax(pi)
 
@@ -44,6 +63,12 @@ class AIPlayer:
             move = self.nnet.mirror_action(move) # Mirror action for other player
         return move
 
+    def close(self):
+        """Stop the search processes of a parallel search, if there are any."""
+        if isinstance(self.mcts, RootParallelMCTS):
+            self.mcts.close()
+        self.mcts = None
+
     def get_last_action(self):
         """Get the last action taken by the AI player."""
         move = self.nnet.decode_action(move)
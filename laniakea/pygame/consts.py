@@ -37,4 +37,9 @@ COLS_SMALL = 6
 BOARD_WIDTH_SMALL = PIECE_WIDTH * COLS_SMALL
 BOARD_HEIGHT_SMALL = PIECE_HEIGHT * COLS_SMALL
 
+# seconds the AI searches for each move
+AI_THINK_TIME = 1.0
+# processes that search in parallel for the AI, each with its own tree
+AI_SEARCH_WORKERS = 1
+
 current_menu = None
\ No newline at end of file
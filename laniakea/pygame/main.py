@@ -42,4 +42,5 @@ while running:
     clock.tick(60)
 
 # Done! Time to quit.
+consts.current_menu.close()
 pygame.quit()
\ No newline at end of file
@@ -52,7 +52,7 @@ class GameMenu(Menu):
             self.screen.blit(won_text, (SCREEN_WIDTH / 2 - won_text.get_rect().width / 2, SCREEN_HEIGHT / 2 - won_text.get_rect().height / 2))
         if self.won_tick != -1 and self.tick - self.won_tick > 60 * 5:
             from laniakea.pygame.ui.main_menu import MainMenu
-            self.swap_menu(MainMenu(self.screen, self.swap_menu))
+            self.swap_menu(MainMenu(self.screen))
 
         self.tick += 1
         super().draw_screen()
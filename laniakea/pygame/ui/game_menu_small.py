@@ -43,10 +43,12 @@ class GameMenuSmall(Menu):
         self.rules_button.set_pos((SCREEN_WIDTH - bounds[0] - 10, 10))
         self.elements.append(self.rules_button)
 
+        self.ai_player = None
         if ai != 0:
             from laniakea.pygame.ai.ai_setup import AIPlayer
             game = LaniakeaGame()
-            self.ai_player = AIPlayer(game, ai, NNetWrapper(game), "smallmap")
+            self.ai_player = AIPlayer(game, ai, NNetWrapper(game), "smallmap", think_time=AI_THINK_TIME,
+                                      num_workers=AI_SEARCH_WORKERS)
             if ai == 1:
                 self.play_ai_move()
 
@@ -61,7 +63,7 @@ class GameMenuSmall(Menu):
             self.screen.blit(won_text, (SCREEN_WIDTH / 2 - won_text.get_rect().width / 2, SCREEN_HEIGHT / 2 - won_text.get_rect().height / 2))
         if self.won_tick != -1 and self.tick - self.won_tick > 60 * 5:
             from laniakea.pygame.ui.main_menu import MainMenu
-            self.swap_menu(MainMenu(self.screen, self.swap_menu))
+            self.swap_menu(MainMenu(self.screen))
             self.won_tick = -1
 
         self.tick += 1
@@ -70,6 +72,14 @@ class GameMenuSmall(Menu):
         if self.showing_rules:
             dh.draw_rules_overlay(self.screen, 2)
 
+    def close(self):
+        """
+        Stops the search processes of the AI player when the game ends or is left.
+        """
+        if self.ai_player is not None:
+            self.ai_player.close()
+            self.ai_player = None
+
     def on_rules_click(self):
         self.showing_rules = not self.showing_rules 
 
@@ -244,6 +254,7 @@ class GameMenuSmall(Menu):
         if self.board.is_win(self.current_player):
             self.who_won = 0 if self.current_player == 1 else 1
             self.won_tick = self.tick
+            self.close()
         self.current_player *= -1
         if self.ai_player is not None:
             self.play_ai_move()
@@ -259,6 +270,7 @@ class GameMenuSmall(Menu):
         if self.board.is_win(self.current_player):
             self.who_won = 0 if self.current_player == 1 else 1
             self.won_tick = self.tick
+            self.close()
         self.current_player *= -1
 
     def filter_possible_first_moves(self):
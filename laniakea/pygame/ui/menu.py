@@ -26,6 +26,13 @@ class Menu:
     def handle_key_input(self, key):
         pass
 
+    def close(self):
+        """
+        Releases what the menu holds, called when it is swapped out.
+        """
+        pass
+
     def swap_menu(self, menu):
         from .. import consts
+        consts.current_menu.close()
         consts.current_menu = menu
\ No newline at end of file
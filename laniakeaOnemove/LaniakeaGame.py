@@ -4,7 +4,7 @@ sys.path.append('..')
 from Game import Game
 from .LaniakeaLogic import Board
 from .LaniakeaHelper import ACTION_SIZE, decode_action, encode_action, decode_stack, mirror_action, encode_stack
-from .LaniakeaBoardConverter import board_to_tensor, tensor_to_board
+from .LaniakeaBoardConverter import board_to_tensor, tensor_to_board, zobrist_hash
 import numpy as np
 import random
 
@@ -99,20 +99,33 @@ class LaniakeaGame(Game):
                         moves that are valid from the current board and player,
                         0 for invalid moves
         """
+        valid_actions = np.zeros(self.getActionSize(), dtype=np.int8)
+        valid_actions[self.getValidActions(board, player)] = 1
+        return valid_actions
+
+    def getValidActions(self, board, player):
+        """
+        Input:
+            board: current board
+            player: current player
+
+        Returns:
+            validActions: a sorted array with the indices of the valid moves,
+                          without building the binary vector of length
+                          self.getActionSize().
+        """
         b = tensor_to_board(board)
         valid_moves = b.get_legal_moves(player)
-        valid_actions = np.zeros(self.getActionSize(), dtype=np.int8)
+        indices = []
 
         for move in valid_moves:
             from_pos, to_pos, insert_rows = move  # Neu: Nur ein Move + Liste an Insert-Zeilen
             if len(insert_rows) == 0:
-                index = encode_action((from_pos, to_pos), 12)
-                valid_actions[index] = 1
+                indices.append(encode_action((from_pos, to_pos), 12))
             for insert_row in insert_rows:
-                index = encode_action((from_pos, to_pos), insert_row)
-                valid_actions[index] = 1
+                indices.append(encode_action((from_pos, to_pos), insert_row))
 
-        return valid_actions
+        return np.unique(np.array(indices, dtype=np.int64))
 
         
     def getGameEnded(self, board, player):
@@ -196,6 +209,17 @@ class LaniakeaGame(Game):
         """
         return [(board, pi)]  # No symmetries in this game
 
+    def getSparseSymmetries(self, board, pi):
+        """
+        Input:
+            board: current board
+            pi: sparse policy, an (actions, probs) pair
+
+        Returns:
+            symmForms: [(board, pi)], the policy is never expanded
+        """
+        return [(board, pi)]  # No symmetries in this game
+
     def stringRepresentation(self, board):
         """
         Input:
@@ -206,6 +230,18 @@ class LaniakeaGame(Game):
                          Required by MCTS for hashing.
         """
         return board.tobytes()
+
+    def hashKey(self, board):
+        """
+        Input:
+            board: current board
+
+        Returns:
+            key: 64 bit Zobrist hash of the board that folds in the stacks,
+                 home counts, score counts and insertable tile. Used by MCTS
+                 instead of stringRepresentation.
+        """
+        return zobrist_hash(board)
     
     @staticmethod
     def display( board):
@@ -42,6 +42,8 @@ class NNetWrapper(NeuralNet):
     * Expects *volumetric* game boards with shape ``(x, y, z)``.
     """
 
+    sparsePolicy = True  # train on (actions, probs) policies, see train
+
     def __init__(self, game):
         super().__init__(game)
 
@@ -56,8 +58,13 @@ class NNetWrapper(NeuralNet):
             self.nnet.cuda()
 
     # ─────────────────────────────────────────────────────────────────── train ──
-    def train(self, examples: List[Tuple[np.ndarray, np.ndarray, float]]):
-        """`examples` is a list of *(board, pi, v)* tuples."""
+    def train(self, examples: List[Tuple[np.ndarray, Tuple[np.ndarray, np.ndarray], float]]):
+        """`examples` is a list of *(board, pi, v)* tuples.
+
+        ``pi`` is a sparse *(actions, probs)* pair, only the few actions the
+        search visited are carried, and the policy loss gathers the network
+        output at those actions. Dense policy vectors are accepted as well.
+        """
         optimizer = optim.Adam(self.nnet.parameters(), lr=args.lr)
 
         for epoch in range(args.epochs):
@@ -72,20 +79,28 @@ class NNetWrapper(NeuralNet):
 
                 # -------- convert to torch tensors ---------------------------
                 boards = torch.FloatTensor(np.array(boards).astype(np.float32))
-                target_pis = torch.FloatTensor(np.array(pis))
+                if isinstance(pis[0], tuple):
+                    target_actions, target_pis = self.sparse_targets(pis)
+                else:
+                    target_actions, target_pis = None, torch.FloatTensor(np.array(pis))
                 target_vs = torch.FloatTensor(np.array(vs).astype(np.float32))
 
 
                 # Ensure 4‑D shape (B, x, y, z) – the net will unsqueeze chan dim
                 boards_t = boards.reshape(-1, self.board_x, self.board_y, self.board_z)
-
+                pis_t, vs_t = target_pis, target_vs
 
                 if args.cuda:
                     boards_t, pis_t, vs_t = boards_t.contiguous().cuda(), target_pis.contiguous().cuda(), target_vs.contiguous().cuda()
+                    if target_actions is not None:
+                        target_actions = target_actions.contiguous().cuda()
 
                 # ---------- forward / backward ------------------------------
                 out_pi, out_v = self.nnet(boards_t)
-                l_pi = self.loss_pi(pis_t, out_pi)
+                if target_actions is not None:
+                    l_pi = self.loss_pi_sparse(target_actions, pis_t, out_pi)
+                else:
+                    l_pi = self.loss_pi(pis_t, out_pi)
                 l_v  = self.loss_v(vs_t, out_v)
                 loss = l_pi + l_v
 
@@ -120,11 +135,51 @@ class NNetWrapper(NeuralNet):
 
         return torch.exp(pi)[0].cpu().numpy(), v[0].cpu().numpy()
 
+    def predictBatch(self, boards: List[np.ndarray]):
+        """Predict *(policies, values)* for several boards in one forward pass.
+
+        Parameters
+        ----------
+        boards : list of np.ndarray
+            Each of shape ``(x, y, z)``.
+        """
+        boards_t = torch.tensor(np.array(boards), dtype=torch.float32).view(
+            -1, self.board_x, self.board_y, self.board_z
+        )
+
+        if args.cuda:
+            boards_t = boards_t.cuda()
+
+        self.nnet.eval()
+        with torch.no_grad():
+            pi, v = self.nnet(boards_t)
+
+        return torch.exp(pi).cpu().numpy(), v.view(-1).cpu().numpy()
+
+    @staticmethod
+    def sparse_targets(pis: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Pad sparse *(actions, probs)* policies into two ``(B, k)`` tensors.
+
+        ``k`` is the largest number of actions of a policy in the batch, the
+        padding points at action 0 with probability 0.
+        """
+        k = max(1, max(len(actions) for actions, _ in pis))
+        actions = np.zeros((len(pis), k), dtype=np.int64)
+        probs = np.zeros((len(pis), k), dtype=np.float32)
+        for i, (a, p) in enumerate(pis):
+            actions[i, :len(a)] = a
+            probs[i, :len(p)] = p
+        return torch.from_numpy(actions), torch.from_numpy(probs)
+
     # ────────────────────────────────────────────────────── loss definitions ──
     @staticmethod
     def loss_pi(targets: torch.Tensor, outputs: torch.Tensor) -> torch.Tensor:
         return -torch.sum(targets * outputs) / targets.size(0)
 
+    @staticmethod
+    def loss_pi_sparse(actions: torch.Tensor, targets: torch.Tensor, outputs: torch.Tensor) -> torch.Tensor:
+        return -torch.sum(targets * outputs.gather(1, actions)) / targets.size(0)
+
     @staticmethod
     def loss_v(targets: torch.Tensor, outputs: torch.Tensor) -> torch.Tensor:
         return torch.sum((targets - outputs.view(-1)) ** 2) / targets.size(0)
@@ -16,6 +16,16 @@ from .LaniakeaLogic import Board
 #   - 2 channels for scored pieces (white and black)
 #   - 4 channels for the insertable tile type (0, 1, or 2, 3)
  
+# Zobrist keys for the hash of a tensor: one key per field and channel for the
+# turtle, empty, piece and player channels, and one key per value of the eight
+# constant channels (home and scored counts, insertable tile). The generator is
+# seeded so that every process computes the same hash for a board.
+_zobrist_rng = np.random.default_rng(0x1A61A6EA)
+ZOBRIST_FIELDS = _zobrist_rng.integers(0, 2 ** 64, size=(6, 5, 9), dtype=np.uint64)
+ZOBRIST_COUNTS = _zobrist_rng.integers(0, 2 ** 64, size=(8, 9), dtype=np.uint64)
+COUNT_CHANNELS = np.arange(8)
+COUNT_SCALES = np.array([8, 8, 5, 5, 1, 1, 1, 1], dtype=np.float32)
+
 def board_to_tensor(board, player):
     rows = 5
     cols = 6
@@ -107,4 +117,12 @@ def tensor_to_board(tensor):
     new_board = Board(False)
     new_board.board = np.array(board_array)
     new_board.board[4][rows] = insert_plate
-    return new_board
\ No newline at end of file
+    return new_board
+
+
+# Returns the 64 bit Zobrist hash of a tensor created by board_to_tensor
+def zobrist_hash(tensor):
+    h = np.bitwise_xor.reduce(ZOBRIST_FIELDS[tensor[:, :, :9] != 0])
+    counts = np.rint(tensor[0, 0, 9:] * COUNT_SCALES).astype(np.intp)
+    h ^= np.bitwise_xor.reduce(ZOBRIST_COUNTS[COUNT_CHANNELS, counts])
+    return int(h)
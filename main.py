@@ -15,12 +15,22 @@ coloredlogs.install(level='INFO')  # Change this to DEBUG to see more info.
 args = dotdict({
     'numIters': 100, 
     'numEps': 150,              # Number of complete self-play games to simulate during a new iteration.
+    'numSelfPlayWorkers': 1,    # Number of processes that play the self-play games of an iteration.
+    'inferenceServer': False,   # Let one process evaluate the boards of all self-play processes in batches.
+    'lockstepGames': 1,         # Number of self-play games a process plays at once, with one batched net call per round.
+    'pipeline': False,          # Overlap self-play, training and gating instead of running them one after the other.
     'tempThreshold': 5,        #
     'updateThreshold': 0.53,     # During arena playoff, new neural net will be accepted if threshold or more of games are won.
     'maxlenOfQueue': 10000,    # Number of game examples to train the neural networks.
     'numMCTSSims': 20,          # Number of games moves for MCTS to simulate.
+    'playoutCapProb': 1.0,      # Fraction of self-play moves that get the full search and become training examples.
+    'numMCTSSimsFast': 5,       # Number of MCTS simulations for the other, unrecorded self-play moves.
     'arenaCompare': 16,         # Number of games to play during arena play to determine if new net will be accepted.
+    'numArenaWorkers': 1,       # Number of processes that play the arena games in parallel.
     'cpuct': 1,
+    'mctsEarlyStop': True,      # Stop the temp=0 searches (arena, pit) once the best move can no longer change.
+    'mctsStatsFile': None,      # Append the counters and timers of every MCTS search to this JSONL file.
+    'evalCacheSize': 0,         # Number of network evaluations each process keeps for its searches, 0 disables the cache.
 
     'checkpoint': './temp/',
     'load_model': True,
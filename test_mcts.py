@@ -0,0 +1,760 @@
+"""
+Unit tests for the MCTS node store. They run the search on TicTacToe with a
+uniform stand-in for the neural network, so no ML framework is required.
+TestLaniakeaGames checks the game hooks MCTS relies on for the Laniakea
+variants along random games.
+
+To run tests:
+python -m pytest test_mcts.py
+"""
+
+import copy
+import json
+import os
+import pickle
+import tempfile
+import threading
+import types
+import unittest
+
+import importlib
+
+import numpy as np
+
+from Coach import Coach
+from EvalCache import EvalCache
+from Game import Game
+from InferenceServer import InferenceServer
+from MCTS import MCTS
+from NeuralNet import NeuralNet
+from ParallelArena import ParallelArena
+from ReplayBuffer import ReplayBuffer
+from RootParallelMCTS import RootParallelMCTS
+from tictactoe.TicTacToeGame import TicTacToeGame
+from utils import dotdict
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class UniformNNet(NeuralNet):
+    """Returns a uniform policy and a neutral value for every board."""
+
+    def __init__(self, game):
+        self.action_size = game.getActionSize()
+
+    def predict(self, board):
+        return np.ones(self.action_size) / self.action_size, 0.
+
+
+class CenterNNet(UniformNNet):
+    """Strongly prefers the center of a TicTacToe board."""
+
+    def predict(self, board):
+        pi = np.ones(self.action_size)
+        pi[4] = 30
+        return pi / np.sum(pi), 0.
+
+
+class SumNNet(UniformNNet):
+    """Returns a uniform policy and the sum of the board as its value."""
+
+    def predict(self, board):
+        return np.ones(self.action_size) / self.action_size, float(np.sum(board))
+
+
+class CheckpointNNet(UniformNNet):
+    """A UniformNNet whose checkpoints are empty files that must exist to be loaded."""
+
+    def save_checkpoint(self, folder, filename):
+        os.makedirs(folder, exist_ok=True)
+        open(os.path.join(folder, filename), 'w').close()
+
+    def load_checkpoint(self, folder, filename):
+        if not os.path.isfile(os.path.join(folder, filename)):
+            raise FileNotFoundError(filename)
+        self.loaded = filename
+
+
+class FailingNNet(UniformNNet):
+    """Fails to evaluate any board."""
+
+    def predictBatch(self, boards):
+        raise ValueError('no evaluation')
+
+
+class CycleGame(Game):
+    """A game that never ends and alternates between two boards."""
+
+    def getInitBoard(self):
+        return np.array([0])
+
+    def getActionSize(self):
+        return 1
+
+    def getNextState(self, board, player, action):
+        return 1 - board, -player
+
+    def getValidMoves(self, board, player):
+        return np.array([1])
+
+    def getGameEnded(self, board, player):
+        return 0
+
+    def getCanonicalForm(self, board, player):
+        return board
+
+    def stringRepresentation(self, board):
+        return board.tobytes()
+
+
+class TestMCTS(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.game = TicTacToeGame()
+        self.args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0})
+
+    def test_policy_covers_only_valid_moves(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = self.game.getInitBoard()
+        board, _ = self.game.getNextState(board, 1, 4)
+        board = self.game.getCanonicalForm(board, -1)
+
+        probs = mcts.getActionProb(board, temp=1)
+        valids = self.game.getValidMoves(board, 1)
+
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        self.assertEqual(np.sum(np.asarray(probs)[valids == 0]), 0)
+
+        actions, sparseProbs = mcts.rootPolicy(1, sparse=True)
+        np.testing.assert_array_equal(actions, np.flatnonzero(probs))
+        np.testing.assert_allclose(sparseProbs, np.asarray(probs)[actions])
+
+    def test_root_visits_match_simulations(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = self.game.getInitBoard()
+        mcts.getActionProb(board, temp=1)
+
+        s = mcts.getNode(board)
+        # the first simulation only expands the root
+        self.assertEqual(np.sum(mcts.Nsa[s]), self.args.numMCTSSims - 1)
+        self.assertEqual(mcts.Ns[s], self.args.numMCTSSims - 1)
+
+    def test_plain_args(self):
+        # args may be any object with attributes, such as rts' _LearnArgs
+        args = types.SimpleNamespace(numMCTSSims=25, cpuct=1.0, tempThreshold=15)
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        probs = mcts.getActionProb(self.game.getInitBoard(), temp=1)
+        self.assertAlmostEqual(np.sum(probs), 1.)
+
+        coach = Coach(self.game, UniformNNet(self.game), args)
+        self.assertGreater(len(coach.executeEpisode()), 0)
+
+    def test_dotdict_args(self):
+        args = dotdict({'numMCTSSims': 25})
+        self.assertEqual(args.numMCTSSims, 25)
+        self.assertEqual(getattr(args, 'cpuct', 1.5), 1.5)
+        with self.assertRaises(AttributeError):
+            args.cpuct
+        self.assertEqual(copy.deepcopy(args), args)
+        self.assertEqual(pickle.loads(pickle.dumps(args)), args)
+
+    def test_playout_cap(self):
+        for playoutCapProb in (0., 0.5):
+            args = dotdict({'numMCTSSims': 25, 'numMCTSSimsFast': 3, 'cpuct': 1.0, 'tempThreshold': 15,
+                            'playoutCapProb': playoutCapProb})
+            coach = Coach(self.game, UniformNNet(self.game), args)
+            searches = []
+            getActionProb = coach.mcts.getActionProb
+
+            def recordSearch(canonicalBoard, **kwargs):
+                pi = getActionProb(canonicalBoard, **kwargs)
+                searches.append((kwargs['numMCTSSims'], pi))
+                return pi
+
+            coach.mcts.getActionProb = recordSearch
+            numFull = numFast = 0
+            for seed in range(5):
+                np.random.seed(seed)
+                examples = coach.executeEpisode()
+                full = [pi for numMCTSSims, pi in searches if numMCTSSims is None]
+                self.assertTrue(all(numMCTSSims in (None, 3) for numMCTSSims, _ in searches))
+                # every full search gives its 8 symmetries, nothing else is recorded
+                self.assertEqual(len(examples), 8 * len(full))
+                for i, pi in enumerate(full):
+                    # the symmetries of a full search permute its policy
+                    for _, (_, probs), _ in examples[8 * i:8 * i + 8]:
+                        self.assertTrue(np.allclose(np.sort(probs), np.sort(pi[1])))
+                numFull += len(full)
+                numFast += len(searches) - len(full)
+                searches.clear()
+            self.assertGreater(numFast, 0)
+            if playoutCapProb == 0:
+                self.assertEqual(numFull, 0)
+            else:
+                self.assertGreater(numFull, 0)
+
+    def test_simulation_override(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = self.game.getInitBoard()
+        mcts.getActionProb(board, temp=1, numMCTSSims=10)
+        self.assertEqual(mcts.Ns[mcts.root], 9)
+
+    def test_progressive_widening(self):
+        args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'pwC': 1.0})
+        mcts = MCTS(self.game, CenterNNet(self.game), args)
+        board = self.game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=1)
+
+        root = mcts.root
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        # the children are ordered by prior and only the first sqrt(N) were eligible
+        self.assertEqual(mcts.As[root][0], 4)
+        self.assertEqual(sorted(mcts.As[root]), list(range(9)))
+        self.assertEqual(np.count_nonzero(mcts.Nsa[root]), np.ceil(np.sqrt(mcts.Ns[root] - 1)))
+
+    def test_batched_search(self):
+        args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'mctsBatchSize': 8})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = self.game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=1)
+
+        s = mcts.getNode(board)
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        self.assertEqual(np.sum(mcts.Nsa[s]), args.numMCTSSims - 1)
+        # all virtual losses have been removed again
+        for visits, values in zip(mcts.Nsa, mcts.Wsa):
+            if visits is not None:
+                self.assertTrue(np.all(visits >= 0))
+                self.assertTrue(np.all(np.abs(values) <= visits))
+
+    def test_threaded_search(self):
+        args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'numSearchThreads': 4})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = self.game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=1)
+
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        self.assertEqual(mcts.Ns[mcts.root], args.numMCTSSims - 1)
+        for visits, values in zip(mcts.Nsa, mcts.Wsa):
+            if visits is not None:
+                self.assertTrue(np.all(visits >= 0))
+                self.assertTrue(np.all(np.abs(values) <= visits))
+
+    def test_advance_keeps_chosen_subtree(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = self.game.getInitBoard()
+        mcts.getActionProb(board, temp=1)
+
+        root = mcts.root
+        i = int(np.argmax(mcts.Nsa[root]))
+        action = mcts.As[root][i]
+        visits = mcts.Nsa[root][i]
+        numNodes = len(mcts.Es)
+
+        mcts.advance(action)
+        nextBoard, player = self.game.getNextState(board, 1, action)
+        nextBoard = self.game.getCanonicalForm(nextBoard, player)
+
+        self.assertEqual(mcts.root, mcts.getNode(nextBoard))
+        self.assertLess(len(mcts.Es), numNodes)
+        # the child was expanded on its first visit, the others went through it
+        self.assertEqual(mcts.Ns[mcts.root], visits - 1)
+
+        mcts.getActionProb(nextBoard, temp=1)
+        self.assertEqual(mcts.Ns[mcts.root], self.args.numMCTSSims)
+
+    def test_cycles_are_cut_off(self):
+        game = CycleGame()
+        mcts = MCTS(game, UniformNNet(game), self.args)
+        board = game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=1)
+
+        self.assertEqual(len(mcts.Es), 2)
+        self.assertEqual(probs[0], 1.)
+        self.assertEqual(mcts.Ns[mcts.root], self.args.numMCTSSims - 1)
+
+    def test_node_budget(self):
+        args = dotdict({'numMCTSSims': 200, 'cpuct': 1.0, 'mctsMaxNodes': 10})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = np.array([[1, 1, 0],
+                          [-1, -1, 0],
+                          [0, 0, 0]])
+
+        probs = mcts.getActionProb(board, temp=0)
+
+        self.assertLessEqual(len(mcts.Es), args.mctsMaxNodes)
+        self.assertEqual(mcts.root, mcts.getNode(board))
+        self.assertEqual(np.argmax(probs), 2)
+
+    def test_time_budget(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = self.game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=1, timeBudget=0., minSims=5)
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        self.assertEqual(mcts.Ns[mcts.root], 4)
+
+        mcts.getActionProb(board, temp=1, timeBudget=60., maxSims=20)
+        self.assertEqual(mcts.Ns[mcts.root], 24)
+
+        # an expired budget still expands the root and visits one action
+        valids = self.game.getValidMoves(board, 1)
+        for temp in (1, 0):
+            mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+            probs = mcts.getActionProb(board, temp=temp, timeBudget=0.)
+            self.assertAlmostEqual(np.sum(probs), 1.)
+            self.assertEqual(np.sum(probs[valids == 0]), 0)
+            self.assertEqual(mcts.Ns[mcts.root], 1)
+
+    def test_early_stop(self):
+        args = dotdict({'numMCTSSims': 200, 'cpuct': 1.0, 'mctsEarlyStop': True})
+        mcts = MCTS(self.game, CenterNNet(self.game), args)
+        board = self.game.getInitBoard()
+
+        probs = mcts.getActionProb(board, temp=0)
+
+        self.assertEqual(np.argmax(probs), 4)
+        self.assertEqual(mcts.Ss[mcts.root], 0)
+        self.assertGreater(mcts.simsSaved, 0)
+        self.assertEqual(mcts.Ns[mcts.root] + mcts.simsSaved, args.numMCTSSims - 1)
+        visits = np.sort(mcts.Nsa[mcts.root])
+        self.assertGreater(visits[-1], visits[-2] + mcts.simsSaved)
+
+    def test_solver(self):
+        args = dotdict({'numMCTSSims': 200, 'cpuct': 1.0})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        # O to move cannot block both the top row and the middle column
+        board = self.game.getCanonicalForm(np.array([[1, 1, 0],
+                                                     [-1, 1, 0],
+                                                     [0, 0, -1]]), -1)
+
+        probs = mcts.getActionProb(board, temp=1)
+
+        self.assertEqual(mcts.Ss[mcts.root], -1)
+        self.assertLess(mcts.Ns[mcts.root], args.numMCTSSims - 1)
+        self.assertTrue(np.all(mcts.Ssa[mcts.root] == -1))
+        self.assertAlmostEqual(np.sum(probs), 1.)
+
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = np.array([[1, 0, 0],
+                          [0, 0, 0],
+                          [0, 0, -1]])
+        probs = mcts.getActionProb(board, temp=1)
+        self.assertEqual(mcts.Ss[mcts.root], 1)
+        self.assertGreater(mcts.simsSaved, 0)
+        # every action with positive probability is a proven win
+        for a in np.flatnonzero(probs):
+            i = int(np.flatnonzero(mcts.As[mcts.root] == a)[0])
+            self.assertEqual(mcts.Ssa[mcts.root][i], 1)
+
+    def test_finds_winning_move(self):
+        mcts = MCTS(self.game, UniformNNet(self.game), self.args)
+        board = np.array([[1, 1, 0],
+                          [-1, -1, 0],
+                          [0, 0, 0]])
+
+        probs = mcts.getActionProb(board, temp=0)
+        self.assertEqual(np.argmax(probs), 2)
+
+    def test_search_stats(self):
+        with tempfile.TemporaryDirectory() as folder:
+            statsFile = os.path.join(folder, 'stats.jsonl')
+            args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'mctsStatsFile': statsFile})
+            mcts = MCTS(self.game, UniformNNet(self.game), args)
+            board = self.game.getInitBoard()
+
+            mcts.getActionProb(board, temp=1)
+            stats = mcts.stats
+            self.assertEqual(stats.sims, args.numMCTSSims)
+            self.assertEqual(stats.nnetEvals + stats.terminalHits + stats.cycleCutoffs, stats.sims)
+            self.assertEqual(stats.nnetEvals, stats.nnetCalls)
+            self.assertGreaterEqual(stats.maxDepth, stats.avgDepth)
+            self.assertGreater(stats.avgDepth, 0)
+
+            mcts.getActionProb(board, temp=1)
+            with open(statsFile) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0]['sims'], args.numMCTSSims)
+            self.assertEqual(lines[1]['sims'], 1)
+
+    def test_shared_eval_cache(self):
+        cache = EvalCache(maxSize=1000)
+        board = self.game.getInitBoard()
+
+        first = MCTS(self.game, UniformNNet(self.game), self.args, cache)
+        first.getActionProb(board, temp=1)
+        self.assertEqual(first.stats.cacheHits, 0)
+        self.assertEqual(len(cache), first.stats.nnetEvals)
+
+        second = MCTS(self.game, UniformNNet(self.game), self.args, cache)
+        second.getActionProb(board, temp=1)
+        self.assertEqual(second.stats.cacheHits, first.stats.nnetEvals)
+        self.assertEqual(second.stats.nnetEvals, 0)
+        np.testing.assert_array_equal(second.Nsa[second.root], first.Nsa[first.root])
+
+        # another model version does not see those evaluations
+        other = MCTS(self.game, UniformNNet(self.game), self.args, cache, modelVersion=1)
+        other.getActionProb(board, temp=1)
+        self.assertEqual(other.stats.cacheHits, 0)
+
+        small = EvalCache(maxSize=10)
+        MCTS(self.game, UniformNNet(self.game), self.args, small).getActionProb(board, temp=1)
+        self.assertEqual(len(small), 10)
+
+    def test_root_parallel_search(self):
+        board = self.game.getInitBoard()
+        with RootParallelMCTS(self.game, UniformNNet, self.args, numWorkers=2) as mcts:
+            probs = mcts.getActionProb(board, temp=1)
+            self.assertAlmostEqual(np.sum(probs), 1.)
+
+            # the visits of both trees are summed
+            counts = mcts.getActionProb(board, temp=1, numMCTSSims=11) * 2 * 10
+            np.testing.assert_allclose(counts, np.round(counts))
+
+            actions, probs = mcts.getActionProb(board, temp=1, sparse=True)
+            self.assertAlmostEqual(np.sum(probs), 1.)
+            self.assertTrue(np.all(self.game.getValidMoves(board, 1)[actions] == 1))
+
+            board = np.array([[1, 1, 0],
+                              [-1, -1, 0],
+                              [0, 0, 0]])
+            self.assertEqual(np.argmax(mcts.getActionProb(board, temp=0)), 2)
+
+    def test_parallel_arena(self):
+        arena = ParallelArena(self.game, UniformNNet, self.args, None, None, numWorkers=2, seed=7)
+        results = arena.playGames(6)
+        self.assertEqual(sum(results), 6)
+
+        # the results only depend on the seed, not on the number of processes
+        self.assertEqual(ParallelArena(self.game, UniformNNet, self.args, None, None, numWorkers=1, seed=7)
+                         .playGames(6), results)
+
+    def test_inference_server(self):
+        args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'mctsBatchSize': 4})
+        board = self.game.getInitBoard()
+        with InferenceServer(self.game, UniformNNet, None, 1, slotSize=4) as server:
+            client = server.clients[0]
+            pi, v = client.predict(board)
+            np.testing.assert_allclose(pi, np.ones(self.game.getActionSize()) / self.game.getActionSize(), rtol=1e-6)
+            self.assertEqual(v, 0)
+
+            mcts = MCTS(self.game, client, args)
+            probs = mcts.getActionProb(board, temp=1)
+            self.assertAlmostEqual(np.sum(probs), 1.)
+            self.assertEqual(mcts.Ns[mcts.root], args.numMCTSSims - 1)
+
+    def test_inference_server_failure(self):
+        board = self.game.getInitBoard()
+        with tempfile.TemporaryDirectory() as folder:
+            for nnetClass, checkpoint in ((FailingNNet, None), (CheckpointNNet, (folder, 'missing.pth.tar'))):
+                with InferenceServer(self.game, nnetClass, checkpoint, 1) as server:
+                    client = server.clients[0]
+                    # the client raises instead of waiting for the failed server
+                    with self.assertRaises(RuntimeError):
+                        client.predict(board)
+                    with self.assertRaises(RuntimeError):
+                        client.predict(board)
+                    server.process.join(timeout=10)
+                    self.assertFalse(server.process.is_alive())
+
+    def test_inference_client_threads(self):
+        board = self.game.getInitBoard()
+        with InferenceServer(self.game, SumNNet, None, 1) as server:
+            client = server.clients[0]
+            errors = []
+
+            def evaluate(k):
+                for _ in range(20):
+                    _, v = client.predict(board + k)
+                    if v != 9 * k:
+                        errors.append((k, v))
+
+            # the threads of a threaded search share the slot of their client
+            threads = [threading.Thread(target=evaluate, args=(k,)) for k in range(1, 5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+    def test_self_play_workers(self):
+        with tempfile.TemporaryDirectory() as folder:
+            args = dotdict({'numMCTSSims': 10, 'cpuct': 1.0, 'tempThreshold': 15, 'numEps': 3,
+                            'numSelfPlayWorkers': 2, 'checkpoint': folder})
+            coach = Coach(self.game, UniformNNet(self.game), args)
+
+            # one episode per task, and groups of two played in lockstep
+            for numGames in (1, 2):
+                episodes = coach.selfPlayParallel(numGames)
+
+                self.assertEqual(len(episodes), 3)
+                for examples in episodes:
+                    self.assertGreater(len(examples), 0)
+                    for board, (actions, probs), v in examples:
+                        self.assertEqual(np.shape(board), (3, 3))
+                        self.assertAlmostEqual(np.sum(probs), 1.)
+                        self.assertIn(round(v), (-1, 0, 1))
+
+    def test_pipelined_learn(self):
+        with tempfile.TemporaryDirectory() as folder:
+            args = dotdict({'numIters': 2, 'numEps': 4, 'tempThreshold': 15, 'updateThreshold': 0.5,
+                            'maxlenOfQueue': 10000, 'numMCTSSims': 10, 'arenaCompare': 2, 'cpuct': 1.0,
+                            'checkpoint': folder, 'numItersForTrainExamplesHistory': 2,
+                            'numSelfPlayWorkers': 2, 'pipeline': True, 'lockstepGames': 2})
+            coach = Coach(self.game, CheckpointNNet(self.game), args)
+            with self.assertLogs('Coach', 'WARNING') as logs:
+                coach.learn()
+            self.assertIn('lockstepGames', ''.join(logs.output))
+
+            self.assertEqual(coach.lastVersion, 2)
+            self.assertIn(coach.acceptedVersion, (0, 1, 2))
+            # nnet ends with the accepted model, the only model file left
+            self.assertEqual(coach.nnetVersion, coach.acceptedVersion)
+            self.assertEqual(coach.nnet.loaded, coach.getVersionFile(coach.acceptedVersion))
+            self.assertEqual([f for f in os.listdir(folder) if f.startswith('model_')],
+                             [coach.getVersionFile(coach.acceptedVersion)])
+
+            # every example carries the model that played it, the first
+            # iteration's episodes were all played by model 0
+            buffer = coach.replayBuffer
+            self.assertEqual(len(buffer.shards), 2)
+            self.assertEqual(buffer.version(0), 0)
+            for i in range(len(buffer)):
+                self.assertIn(buffer.version(i), (0, 1, 2))
+
+            # gating accepts a candidate that won enough of the decided games
+            coach.acceptedVersion = 0
+            coach.nnet.save_checkpoint(folder, coach.getVersionFile(2))
+            coach.gate(1, types.SimpleNamespace(get=lambda: (3, 1, 0)), 3)
+            self.assertEqual(coach.acceptedVersion, 0)
+            coach.gate(2, types.SimpleNamespace(get=lambda: (1, 3, 0)), 3)
+            self.assertEqual(coach.acceptedVersion, 2)
+            self.assertTrue(os.path.isfile(os.path.join(folder, 'best.pth.tar')))
+            self.assertTrue(os.path.isfile(os.path.join(folder, coach.getCheckpointFile(3))))
+
+    def test_lockstep_self_play(self):
+        with tempfile.TemporaryDirectory() as folder:
+            statsFile = os.path.join(folder, 'stats.jsonl')
+            args = dotdict({'numMCTSSims': 25, 'cpuct': 1.0, 'tempThreshold': 15, 'mctsStatsFile': statsFile})
+            coach = Coach(self.game, UniformNNet(self.game), args)
+
+            episodes = coach.executeEpisodesLockstep(4)
+
+            # every search of every game is recorded
+            with open(statsFile) as f:
+                stats = [json.loads(line) for line in f]
+        self.assertGreaterEqual(len(stats), sum(len(examples) // 8 for examples in episodes))
+        self.assertGreater(sum(s['nnetCalls'] for s in stats), 0)
+        self.assertEqual(sum(s['nnetCalls'] for s in stats), sum(s['nnetEvals'] for s in stats))
+
+        self.assertEqual(len(episodes), 4)
+        for examples in episodes:
+            # every move is recorded with its 8 symmetries
+            self.assertGreater(len(examples), 0)
+            self.assertEqual(len(examples) % 8, 0)
+            for board, (actions, probs), v in examples:
+                self.assertEqual(np.shape(board), (3, 3))
+                self.assertEqual(len(actions), len(probs))
+                self.assertTrue(np.all(probs > 0))
+                self.assertAlmostEqual(np.sum(probs), 1.)
+                self.assertIn(round(v), (-1, 0, 1))
+
+    def test_replay_buffer(self):
+        board = self.game.getInitBoard()
+        pi = np.zeros(self.game.getActionSize())
+        pi[[2, 4]] = 0.5
+        with tempfile.TemporaryDirectory() as folder:
+            buffer = ReplayBuffer(folder, 2, self.game.getActionSize())
+            for iteration in range(3):
+                buffer.addShard([(board + iteration, pi, 1, iteration), (board - iteration, pi, -1, iteration)])
+            # the first shard has left the window
+            self.assertEqual(len(buffer), 4)
+            b, p, v = buffer[0]
+            np.testing.assert_array_equal(b, board + 1)
+            np.testing.assert_array_equal(p, pi)
+            self.assertEqual(v, 1.)
+            self.assertEqual(buffer.version(-1), 2)
+
+            reopened = ReplayBuffer(folder, 2, self.game.getActionSize())
+            self.assertEqual(reopened.open(), 2)
+            np.testing.assert_array_equal(reopened[3][0], board - 2)
+            self.assertEqual(reopened[3][2], -1.)
+            with self.assertRaises(IndexError):
+                reopened[4]
+
+            sparse = ReplayBuffer(folder, 2, self.game.getActionSize(), sparse=True)
+            sparse.open()
+            sparse.addShard([(board, MCTS.sparsePolicy(pi), 0)])
+            _, (actions, probs), _ = sparse[-1]
+            np.testing.assert_array_equal(actions, [2, 4])
+            np.testing.assert_array_equal(probs, [0.5, 0.5])
+            np.testing.assert_array_equal(sparse[0][1][0], [2, 4])
+
+    def test_load_legacy_examples(self):
+        board = self.game.getInitBoard()
+        pi = np.zeros(self.game.getActionSize())
+        pi[4] = 1.
+        with tempfile.TemporaryDirectory() as loadFolder, tempfile.TemporaryDirectory() as checkpoint:
+            with open(os.path.join(loadFolder, 'best.pth.tar.examples'), 'wb') as f:
+                pickle.dump([[(board, pi, 1)] * 2, [(board, pi, -1)] * 3], f)
+            args = dotdict({'numMCTSSims': 10, 'cpuct': 1.0, 'checkpoint': checkpoint,
+                            'load_folder_file': (loadFolder, 'best.pth.tar'), 'numItersForTrainExamplesHistory': 5})
+
+            # a restart finds the converted shards instead of converting again
+            for _ in range(2):
+                coach = Coach(self.game, UniformNNet(self.game), args)
+                coach.loadTrainExamples()
+                self.assertTrue(coach.skipFirstSelfPlay)
+                self.assertEqual(len(ReplayBuffer.listShards(os.path.join(loadFolder, 'replay'))), 2)
+                self.assertEqual(len(coach.replayBuffer), 5)
+                self.assertEqual(coach.replayBuffer[-1][2], -1.)
+
+    def test_gumbel_search(self):
+        args = dotdict({'numMCTSSims': 50, 'cpuct': 1.0, 'gumbel': True, 'gumbelActions': 4})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = np.array([[1, 1, 0],
+                          [-1, -1, 0],
+                          [0, 0, 0]])
+
+        probs = mcts.getActionProb(board, temp=1)
+        valids = self.game.getValidMoves(board, 1)
+
+        self.assertAlmostEqual(np.sum(probs), 1.)
+        self.assertEqual(np.sum(probs[valids == 0]), 0)
+        self.assertEqual(np.argmax(probs), 2)
+        self.assertEqual(mcts.selectedAction, 2)
+        # the winning move is proven long before the budget is spent
+        self.assertLess(mcts.Ns[mcts.root], args.numMCTSSims - 1)
+
+    def test_gumbel_proven_loss(self):
+        args = dotdict({'numMCTSSims': 200, 'cpuct': 1.0, 'gumbel': True, 'tempThreshold': 15})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = self.game.getCanonicalForm(np.array([[1, 1, 0],
+                                                     [-1, 1, 0],
+                                                     [0, 0, -1]]), -1)
+        valids = self.game.getValidMoves(board, 1)
+        mcts.getActionProb(board, temp=1)
+        self.assertEqual(mcts.Ss[mcts.root], -1)
+
+        # the second search starts at the proven lost root
+        for temp in (1, 0):
+            probs = mcts.getActionProb(board, temp=temp)
+            self.assertAlmostEqual(np.sum(probs), 1.)
+            self.assertEqual(np.sum(probs[valids == 0]), 0)
+            self.assertEqual(valids[mcts.selectedAction], 1)
+
+        coach = Coach(self.game, UniformNNet(self.game), args)
+        for seed in range(10):
+            np.random.seed(seed)
+            coach.mcts = MCTS(self.game, coach.nnet, args)
+            self.assertGreater(len(coach.executeEpisode()), 0)
+
+    def test_gumbel_terminal_root(self):
+        args = dotdict({'numMCTSSims': 20, 'cpuct': 1.0, 'gumbel': True})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = np.array([[1, 1, 1],
+                          [-1, -1, 0],
+                          [0, 0, 0]])
+        probs = mcts.getActionProb(board, temp=1)
+        self.assertEqual(np.sum(probs), 0)
+        self.assertIsNone(mcts.selectedAction)
+
+    def test_gumbel_tree_reuse(self):
+        # inherited visits count towards the budget, as for the PUCT search
+        args = dotdict({'numMCTSSims': 30, 'cpuct': 1.0, 'gumbel': True})
+        mcts = MCTS(self.game, UniformNNet(self.game), args)
+        board = self.game.getInitBoard()
+        mcts.getActionProb(board, temp=1)
+        visits = mcts.Ns[mcts.root]
+        self.assertLessEqual(visits, args.numMCTSSims)
+        mcts.getActionProb(board, temp=1)
+        self.assertLessEqual(mcts.Ns[mcts.root], args.numMCTSSims)
+        mcts.getActionProb(board, temp=1, numMCTSSims=visits + 10)
+        self.assertEqual(mcts.Ns[mcts.root], visits + 10)
+
+
+class TestLaniakeaGames(unittest.TestCase):
+
+    packages = ('laniakea', 'laniakeaSmallMap', 'laniakeaOnemove')
+
+    @staticmethod
+    def playRandomGame(game, maxMoves=60):
+        """
+        Returns:
+            boards: the canonical boards of a random game of at most maxMoves moves
+        """
+        boards = []
+        board = game.getInitBoard()
+        player = 1
+        while game.getGameEnded(board, player) == 0 and len(boards) < maxMoves:
+            canonicalBoard = game.getCanonicalForm(board, player)
+            boards.append(canonicalBoard)
+            action = np.random.choice(game.getValidActions(canonicalBoard, 1))
+            board, player = game.getNextState(board, player, action)
+        return boards
+
+    def test_hash_keys(self):
+        for package in self.packages:
+            np.random.seed(0)
+            game = importlib.import_module(package + '.LaniakeaGame').LaniakeaGame()
+            boards = self.playRandomGame(game)
+
+            keys = {}
+            for board in boards:
+                key = game.hashKey(board)
+                # equal boards give equal keys
+                self.assertEqual(game.hashKey(board.copy()), key)
+                keys.setdefault(key, set()).add(board.tobytes())
+            # distinct boards give distinct keys
+            for key, distinct in keys.items():
+                self.assertEqual(len(distinct), 1, package)
+            self.assertEqual(len(keys), len({board.tobytes() for board in boards}))
+
+    def test_valid_actions(self):
+        for package in self.packages:
+            np.random.seed(0)
+            game = importlib.import_module(package + '.LaniakeaGame').LaniakeaGame()
+            for board in self.playRandomGame(game):
+                np.testing.assert_array_equal(game.getValidActions(board, 1),
+                                              np.flatnonzero(game.getValidMoves(board, 1)), package)
+
+        # the default of Game, here for TicTacToe
+        np.random.seed(0)
+        game = TicTacToeGame()
+        for board in self.playRandomGame(game):
+            np.testing.assert_array_equal(game.getValidActions(board, 1), np.flatnonzero(game.getValidMoves(board, 1)))
+
+
+    @unittest.skipIf(torch is None, 'needs torch')
+    def test_sparse_policy_loss(self):
+        np.random.seed(0)
+        actionSize = 50
+        pis = []
+        for k in (1, 3, 7):
+            actions = np.random.choice(actionSize, size=k, replace=False).astype(np.int32)
+            probs = np.random.random(k).astype(np.float32)
+            pis.append((actions, probs / np.sum(probs)))
+        dense = np.zeros((len(pis), actionSize), dtype=np.float32)
+        for i, (actions, probs) in enumerate(pis):
+            dense[i, actions] = probs
+        outputs = torch.log_softmax(torch.randn(len(pis), actionSize), dim=1)
+
+        for package in self.packages:
+            wrapper = importlib.import_module(package + '.pytorch.NNet').NNetWrapper
+            actions, probs = wrapper.sparse_targets(pis)
+            self.assertEqual(tuple(actions.shape), (3, 7))
+            self.assertAlmostEqual(wrapper.loss_pi_sparse(actions, probs, outputs).item(),
+                                   wrapper.loss_pi(torch.from_numpy(dense), outputs).item(), places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,5 +18,26 @@ class AverageMeter(object):
 
 
 class dotdict(dict):
+    """
+    A dict whose keys can also be read as attributes. A missing key raises
+    AttributeError, not KeyError, so getattr(args, name, default) returns
+    default and copy and pickle see an ordinary object.
+    """
+
     def __getattr__(self, name):
-        return self[name]
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def setTorchThreads(numThreads):
+    """
+    Limits torch, if it is installed, to numThreads threads, so that several
+    worker processes do not oversubscribe the cores.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(max(1, numThreads))